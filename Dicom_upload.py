@@ -2,91 +2,475 @@
 """
 Created on Thu Jan  3 14:35:01 2019
 
+Uploads a treatment session to its two destinations at the same time:
+    PACS: SFTP to the PACS host, then the host's script pushes the session into PACS
+    WB:   FTP to the WB machine
+
+Each file is read from disk once and handed to both destinations. A transfer manifest in the
+session directory records what each destination already has, so re-running an upload only
+sends missing or changed files.
+
 @author: mpetterson
 """
 
 
+import io
 import os
-import paramiko
-from ftplib import FTP
+import json
+import time
+import hashlib
+import queue
+import threading
+from ftplib import FTP, error_perm
+from collections import namedtuple
 
+import Generate_RTIP_trace as trace
 
-def upload(pdir):
-    """Uploads entire treatment session to both PACS and server. Must be onsite to work"""
-    
-    #Select folder to copy over
-    directory_name = pdir
-    files = [f for f in os.listdir(path=directory_name)]
-    
-    #Get environment
-    f = open('credentials.txt', 'r')
-    credentials = f.readlines()
+
+#Transfer manifest kept in each session directory
+MANIFEST_NAME = '.transfer_manifest.json'
+
+#Deliveries are written to the manifest file in batches: every this many files or seconds
+MANIFEST_SAVE_FILES = 25
+MANIFEST_SAVE_SECONDS = 5.0
+
+#Error of a destination aborted because the upload stopped early (cancelled or unreadable file)
+STOPPED = 'Stopped before every file was read'
+
+#Outcome of the upload to one destination
+TransferResult = namedtuple('TransferResult', ['destination', 'ok', 'files', 'bytes', 'retries', 'seconds', 'message'])
+
+
+def read_credentials(file='credentials.txt'):
+    """Reads PACS host and WB machine logins. Line 1: address user password. Line 2: address user password port"""
+
+    with open(file, 'r') as f:
+        credentials = f.readlines()
     pacs = credentials[0].replace('\n','').split(' ')
-    wb = credentials[1].split(' ')
+    wb = credentials[1].replace('\n','').split(' ')
     pacs_info = {"address": pacs[0], "username": pacs[1], "password": pacs[2]}
-    wb_info = {"address": wb[0], "username": wb[1], "password": wb[2], "port": wb[3]}  
-        
+    wb_info = {"address": wb[0], "username": wb[1], "password": wb[2], "port": int(wb[3])}
 
-    #Connect to host/PACS computer
-    try:
-        ssh_client_pacs = paramiko.SSHClient()
-        ssh_client_pacs.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client_pacs.connect(hostname=pacs_info['address'], username=pacs_info['username'], password=pacs_info['password'])
-        print("Connected to PACS host")
-        
-    except:
-        msg = "Could not connect to network."
-        return msg
-        
-    #Upload data to host
-    try:
-        stdin,stdout,stderr = ssh_client_pacs.exec_command('cd sessions; mkdir %s; ls' % directory_name)
-        print("Directory created. Starting upload")
-    
-        #Uploading directory - using recursive file upload
-        for f in files:
-            ftp_client = ssh_client_pacs.open_sftp()
-            ftp_client.put(os.path.join(directory_name,f),'sessions/'+directory_name+f)
-            ftp_client.close()
-    
-    except:
-        msg = "Could not upload files"
-        return msg
-        
-    #Transmit to PACS
-    print("Transmitting to PACS")
-    try:
-        stdin,stdout,stderr = ssh_client_pacs.exec_command('./upload_session_data_to_pacs.sh ~/sessions/'+directory_name)
-        print(stdout.readlines())
-        print(directory_name)
-        ssh_client_pacs.close()
-    except:
-        msg = "Could not transmist files to PACS"
-        return msg
-    
-    #FTP into second VM
-    try:    
-        print('FTP into WB computer')
-        ftp_client = FTP()
-        ftp_client.connect(wb_info['address'], wb_info['port'])
-        ftp_client.login(wb_info['username'], wb_info['password'])
-        #ftp_client.retrlines('LIST')
-    except:
-        msg = "Could not connect to WB computer"
-        return msg
-    
-    #Copy dicom files over one at a time (only works for dicom. Use storlines for text files)
-    try:
-        ftp_client.mkd(directory_name)
+    return pacs_info, wb_info
+
+
+class PacsSink(object):
+    """SFTP upload to the PACS host over one SSH transport, one SFTP channel per worker thread"""
+
+    name = 'PACS'
+
+    def __init__(self, info, directory_name, workers=4, retries=2):
+        self.info = info
+        self.directory_name = directory_name
+        self.workers = workers
+        self.retries = retries
+        self.retry_count = 0
+        self._local = threading.local()
+        self._channels = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        #paramiko is slow to import, only load it when a PACS upload actually starts
+        import paramiko
+        try:
+            self.ssh_client = paramiko.SSHClient()
+            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            self.ssh_client.connect(hostname=self.info['address'], username=self.info['username'], password=self.info['password'])
+            print("Connected to PACS host")
+        except Exception as e:
+            raise IOError("Could not connect to network. %s" % e)
+
+        try:
+            stdin,stdout,stderr = self.ssh_client.exec_command('cd sessions; mkdir %s; ls' % self.directory_name)
+            stdout.channel.recv_exit_status()
+            self.transport = self.ssh_client.get_transport()
+            print("Directory created. Starting upload")
+        except Exception as e:
+            raise IOError("Could not upload files. %s" % e)
+
+    def _channel(self):
+        #Open one channel per worker thread and keep reusing it
+        if getattr(self._local, 'sftp', None) is None:
+            import paramiko
+            self._local.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            with self._lock:
+                self._channels.append(self._local.sftp)
+        return self._local.sftp
+
+    def send(self, f, payload):
+        for attempt in range(self.retries+1):
+            try:
+                self._channel().putfo(io.BytesIO(payload), 'sessions/'+self.directory_name+f, len(payload))
+                return
+            except Exception as e:
+                #Drop the channel, it may be broken, and try again on a new one
+                try:
+                    self._local.sftp.close()
+                except Exception:
+                    pass
+                self._local.sftp = None
+                if attempt == self.retries:
+                    raise IOError("Could not upload files. %s: %s" % (f, e))
+                with self._lock:
+                    self.retry_count += 1
+
+    def close(self):
+        for sftp in self._channels:
+            sftp.close()
+
+        #Transmit to PACS
+        print("Transmitting to PACS")
+        try:
+            stdin,stdout,stderr = self.ssh_client.exec_command('./upload_session_data_to_pacs.sh ~/sessions/'+self.directory_name)
+            print(stdout.readlines())
+            status = stdout.channel.recv_exit_status()
+            errors = ''.join(stderr.readlines()).strip()
+            self.ssh_client.close()
+        except Exception as e:
+            raise IOError("Could not transmist files to PACS. %s" % e)
+
+        #The files are only in PACS once the script succeeds
+        if status != 0:
+            raise IOError("Could not transmist files to PACS. Upload script exited with %d. %s" % (status, errors))
+
+    def abort(self):
+        try:
+            self.ssh_client.close()
+        except Exception:
+            pass
+
+
+class WbSink(object):
+    """FTP upload to the WB machine. ftplib connections are not thread safe so this uses one worker"""
+
+    name = 'WB'
+    workers = 1
+    retry_count = 0
+
+    def __init__(self, info, directory_name):
+        self.info = info
+        self.directory_name = directory_name
+
+    def open(self):
+        try:
+            print('FTP into WB computer')
+            self.ftp_client = FTP()
+            self.ftp_client.connect(self.info['address'], self.info['port'])
+            self.ftp_client.login(self.info['username'], self.info['password'])
+        except Exception as e:
+            raise IOError("Could not connect to WB computer. %s" % e)
+
+        #Directory is already there when resuming an upload
+        try:
+            self.ftp_client.mkd(self.directory_name)
+        except error_perm:
+            pass
+        except Exception as e:
+            raise IOError("Could not transmit files to WB computer. %s" % e)
         print("Copying dicom files to WB server")
-        for f in files:
-            with open(os.path.join(directory_name,f),'rb') as dcm_file:
-                ftp_client.storbinary('STOR %s' % os.path.join(directory_name,f), dcm_file)
-        ftp_client.quit()
+
+    def send(self, f, payload):
+        #Binary transfer (only works for dicom. Use storlines for text files)
+        try:
+            self.ftp_client.storbinary('STOR %s' % os.path.join(self.directory_name,f), io.BytesIO(payload))
+        except Exception as e:
+            raise IOError("Could not transmit files to WB computer. %s: %s" % (f, e))
+
+    def close(self):
+        self.ftp_client.quit()
         print("Finished copying files to remote server")
-    except:
-        msg = "Could not transmit files to WB computer"
-        return msg
-    
-    msg = "Everything worked, surprisingly"
-    return msg
\ No newline at end of file
+
+    def abort(self):
+        try:
+            self.ftp_client.close()
+        except Exception:
+            pass
+
+
+class TransferManifest(object):
+    """Per-session record of file size/mtime/hash, of which version each destination already has and
+    of whether the destination was closed (for PACS: the session pushed on) since its last new file.
+    Kept as a json file in the session directory so an interrupted upload can be resumed. Deliveries
+    are saved in batches (a crash resends at most the last batch), finalizing is saved immediately"""
+
+    def __init__(self, directory_name):
+        self.path = os.path.join(directory_name, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+        self.files = manifest.get('files', {})
+        self.delivered = manifest.get('delivered', {})
+        self.finalized = manifest.get('finalized', {})
+        self._unsaved = 0
+        self._saved_at = time.time()
+
+    def known_hash(self, f, st):
+        """Hash of f if it hasn't changed on disk since it was last hashed, otherwise None"""
+        entry = self.files.get(f)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry['sha1']
+        return None
+
+    def update(self, f, st, digest):
+        with self._lock:
+            self.files[f] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest}
+
+    def needs(self, destination, f, digest):
+        return self.delivered.get(destination, {}).get(f) != digest
+
+    def needs_finalize(self, destination):
+        """True if files were sent to destination since it was last closed successfully"""
+        return not self.finalized.get(destination, True)
+
+    def mark_delivered(self, destination, f, digest):
+        with self._lock:
+            self.delivered.setdefault(destination, {})[f] = digest
+            self.finalized[destination] = False
+            self._unsaved += 1
+            if self._unsaved >= MANIFEST_SAVE_FILES or time.time() - self._saved_at >= MANIFEST_SAVE_SECONDS:
+                self._save()
+
+    def mark_finalized(self, destination):
+        with self._lock:
+            self.finalized[destination] = True
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'delivered': self.delivered, 'finalized': self.finalized}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+        self._saved_at = time.time()
+
+
+def _run_sink(sink, items, results, manifest=None, progress=None, parent=None, complete=None):
+    """Sends every (name, bytes, hash) item from the sink's queue. The destination is only opened
+    once there is something to send. Keeps draining the queue after an error.
+    The sink is closed (for PACS: the session pushed on) only if the complete event is set once the
+    queue is drained, i.e. every file was queued; otherwise it is aborted"""
+
+    with trace.span('upload.' + sink.name, parent=parent, workers=sink.workers) as s:
+        _drain_sink(sink, items, results, manifest, progress, s, complete)
+
+
+def _drain_sink(sink, items, results, manifest, progress, sink_span, complete=None):
+    start = time.time()
+    state = {'files': 0, 'bytes': 0, 'error': None, 'opened': False}
+    lock = threading.Lock()
+
+    def open_once():
+        with lock:
+            if not state['opened'] and state['error'] is None:
+                state['opened'] = True
+                try:
+                    with trace.span('open.' + sink.name, parent=sink_span):
+                        sink.open()
+                except Exception as e:
+                    state['error'] = str(e)
+
+    def worker():
+        while True:
+            item = items.get()
+            if item is None:
+                break
+            open_once()
+            if state['error'] is not None:
+                continue
+            f, payload, digest = item
+            try:
+                t0 = time.time()
+                sink.send(f, payload)
+                if manifest is not None:
+                    manifest.mark_delivered(sink.name, f, digest)
+                with lock:
+                    state['files'] += 1
+                    state['bytes'] += len(payload)
+                sink_span.add(bytes=len(payload), files=1)
+                if progress is not None:
+                    progress(sink.name, f, len(payload), time.time() - t0)
+            except Exception as e:
+                state['error'] = str(e)
+
+    threads = [threading.Thread(target=worker) for i in range(sink.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    #Nothing left to send, but the last run didn't get as far as closing (e.g. the PACS script failed)
+    finished = complete is None or complete.is_set()
+    if finished and not state['opened'] and manifest is not None and manifest.needs_finalize(sink.name):
+        open_once()
+
+    if not state['opened']:
+        message = 'Up to date'
+    elif state['error'] is None and not finished:
+        state['error'] = STOPPED
+        sink.abort()
+    elif state['error'] is None:
+        try:
+            with trace.span('close.' + sink.name):
+                sink.close()
+            if manifest is not None:
+                manifest.mark_finalized(sink.name)
+        except Exception as e:
+            state['error'] = str(e)
+            sink.abort()
+        message = 'Done'
+    else:
+        sink.abort()
+
+    ok = state['error'] is None
+    sink_span.error = state['error']
+    sink_span.set(retries=sink.retry_count)
+    results[sink.name] = TransferResult(sink.name, ok, state['files'], state['bytes'], sink.retry_count,
+                                        time.time() - start, message if ok else state['error'])
+
+
+def transfer(directory_name, files, sinks, manifest=None, queue_size=16, progress=None, cancel=None, read=None):
+    """Reads each file once and fans it out to every sink, with all sinks running concurrently.
+    With a manifest, only files that a destination doesn't already have (same hash) are sent,
+    and unchanged files that every destination has are not read at all. Returns {destination: TransferResult}
+
+    progress(destination, file, bytes, seconds) is called from the sink threads after each file.
+    Setting the cancel event, or a file that can't be read, stops reading new files; files already
+    queued are still sent but the destinations are aborted rather than closed.
+    read(file) can supply the file contents from memory; files it returns None for are read from disk"""
+
+    with trace.span('upload', session=directory_name) as upload_span:
+        results = _transfer(directory_name, files, sinks, manifest, queue_size, progress, cancel, read, upload_span)
+        upload_span.error = '; '.join('%s: %s' % (r.destination, r.message) for r in results.values() if not r.ok) or None
+
+    return results
+
+
+def _transfer(directory_name, files, sinks, manifest, queue_size, progress, cancel, read, upload_span):
+    results = {}
+    complete = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for s in sinks]
+    threads = [threading.Thread(target=_run_sink, args=(s, q, results, manifest, progress, upload_span, complete))
+               for s,q in zip(sinks, queues)]
+    for t in threads:
+        t.start()
+
+    cancelled = False
+    read_error = None
+    try:
+        for f in files:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+
+            try:
+                path = os.path.join(directory_name,f)
+                st = os.stat(path)
+                digest = manifest.known_hash(f, st) if manifest is not None else None
+                if digest is not None and not any(manifest.needs(s.name, f, digest) for s in sinks):
+                    continue
+
+                payload = read(f) if read is not None else None
+                if payload is None:
+                    with open(path, 'rb') as dcm_file:
+                        payload = dcm_file.read()
+            except Exception as e:
+                #Stop reading; files already queued are still sent
+                read_error = "Could not read %s. %s" % (f, e)
+                break
+
+            digest = hashlib.sha1(payload).hexdigest()
+            upload_span.add(bytes=len(payload), files=1)
+            if manifest is not None:
+                manifest.update(f, st, digest)
+
+            for s,q in zip(sinks, queues):
+                if manifest is None or manifest.needs(s.name, f, digest):
+                    q.put((f, payload, digest))
+
+        if not cancelled and read_error is None:
+            complete.set()
+
+    finally:
+        #One stop marker per worker, whatever happened above, so the sink threads finish and
+        #close (or abort) their connections
+        for s,q in zip(sinks, queues):
+            for i in range(s.workers):
+                q.put(None)
+        for t in threads:
+            t.join()
+
+        if manifest is not None:
+            manifest.save()
+
+    #Resuming with the manifest picks up the files that weren't sent
+    if cancelled:
+        for s in sinks:
+            results[s.name] = results[s.name]._replace(ok=False, message='Cancelled')
+    if read_error is not None:
+        for s in sinks:
+            r = results[s.name]
+            own_error = not r.ok and r.message != STOPPED
+            results[s.name] = r._replace(ok=False, message='%s; %s' % (r.message, read_error) if own_error else read_error)
+
+    return dict((s.name, results[s.name]) for s in sinks)
+
+
+def pending_sends(directory_name, files=None, resume=True, destinations=(PacsSink.name, WbSink.name)):
+    """Number of (destination, file) sends an upload of the session will make: every file to every
+    destination without resume, otherwise only changed files or files a destination doesn't have.
+    Only stats files; a changed file with the same content is counted but not sent"""
+
+    files = session_files(directory_name) if files is None else files
+    if not resume:
+        return len(files)*len(destinations)
+
+    manifest = TransferManifest(directory_name)
+    total = 0
+    for f in files:
+        digest = manifest.known_hash(f, os.stat(os.path.join(directory_name, f)))
+        total += sum(1 for d in destinations if digest is None or manifest.needs(d, f, digest))
+
+    return total
+
+
+def session_files(directory_name):
+    """Files of a session to upload. Hidden files (transfer manifest etc.) are skipped"""
+    return sorted(f for f in os.listdir(directory_name) if not f.startswith('.') and os.path.isfile(os.path.join(directory_name,f)))
+
+
+def upload(pdir, workers=4, resume=True, progress=None, cancel=None, read=None):
+    """Uploads entire treatment session to both PACS and server. Must be onsite to work.
+    With resume, files already delivered unchanged to a destination are skipped.
+    read(file) can supply file contents already in memory (see transfer)"""
+
+    #Select folder to copy over
+    directory_name = pdir
+    files = session_files(directory_name)
+
+    #Get environment
+    pacs_info, wb_info = read_credentials()
+
+    sinks = [PacsSink(pacs_info, directory_name, workers), WbSink(wb_info, directory_name)]
+    manifest = TransferManifest(directory_name) if resume else None
+
+    return transfer(directory_name, files, sinks, manifest, progress=progress, cancel=cancel, read=read)
+
+
+def format_results(results):
+    """One line per destination for display"""
+
+    if all(r.ok for r in results.values()):
+        lines = ["Everything worked, surprisingly"]
+    else:
+        lines = []
+    for r in results.values():
+        lines.append("%s: %s (%d files, %.1f MB in %.1f s)" % (r.destination, r.message, r.files, r.bytes/1e6, r.seconds))
+
+    return '\n'.join(lines)
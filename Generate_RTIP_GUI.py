@@ -13,22 +13,96 @@ Roughly organized into three panes:
 @author: mpetterson
 """
 
+import time
+_start = time.perf_counter()
+
 import sys, os
-import numpy as np
-import Generate_RTIP_func1 as gen1
-import Generate_RTIP_func2 as gen2
-import Generate_RTIP_func3 as gen3
+import importlib
+import Generate_RTIP_index as index
+import Generate_RTIP_jobs as jobs
+import Generate_RTIP_trace as trace
 
 from PyQt5.QtWidgets import QLabel, QTextEdit, QMainWindow, QAction, QLineEdit, qApp, QSlider, QPushButton, QFormLayout
 from PyQt5.QtWidgets import QVBoxLayout, QApplication, QWidget, QCheckBox, QRadioButton, QHBoxLayout, QFileDialog, QComboBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QProgressBar
+from PyQt5.QtCore import Qt, QTimer
+
+class _LazyModule(object):
+    """Stands in for a module and imports it on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+#numpy, matplotlib, the dicom stack and the network libraries are only imported when first
+#needed (phantom selected, spot map loaded, Generate/Upload clicked) so the window shows quickly
+np = _LazyModule('numpy')
+matplotlib = _LazyModule('matplotlib')
+backend_qt5agg = _LazyModule('matplotlib.backends.backend_qt5agg')
+mpl_figure = _LazyModule('matplotlib.figure')
+gen2 = _LazyModule('Generate_RTIP_func2')
+cache = _LazyModule('Generate_RTIP_cache')
+plot = _LazyModule('Generate_RTIP_plot')
+compare = _LazyModule('Generate_RTIP_compare')
+Dicom_upload = _LazyModule('Dicom_upload')
+
+
+def _has_layer_columns(spots):
+    """True if a spot map has energy, x, y and Gp columns. Phantom spot maps come from
+    Generate_RTIP_func1.plot_rtip_map, of which only x and y (columns 1 and 2) are relied on"""
+    return spots.ndim == 2 and spots.shape[1] >= 4
+
+
+
+class DoseViewer(QWidget):
+    """Slice by slice view of a 3D dose grid (axial slices, slider along z)"""
 
-import matplotlib
-matplotlib.use("Qt5Agg")
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.figure import Figure
+    def __init__(self, grid, title="3D dose"):
+        super().__init__()
+
+        self.grid = grid
+        self.setWindowTitle(title)
+        self.setGeometry(650,250,600,650)
+        nz, ny, nx = grid.dose.shape
+        x0, y0, z0 = grid.origin
+        dx, dy, dz = grid.spacing
+        self.z = z0 + dz*np.arange(nz)
+
+        self.fig = mpl_figure.Figure()
+        self.canvas = backend_qt5agg.FigureCanvasQTAgg(self.fig)
+        self.axes = self.fig.add_subplot(1,1,1)
+        self.image = self.axes.imshow(grid.dose[0], origin='upper', cmap='jet', vmin=0, vmax=max(grid.dose.max(), 1e-12),
+                                      extent=[x0-dx/2, x0+dx*(nx-0.5), y0+dy*(ny-0.5), y0-dy/2])
+        self.axes.set_xlabel("X(mm)")
+        self.axes.set_ylabel("Y(mm)")
+        self.fig.colorbar(self.image, ax=self.axes, label="Dose (arb)")
+
+        self.slice_lbl = QLabel()
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setRange(0, nz-1)
+        self.slider.valueChanged.connect(self.show_slice)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.canvas)
+        layout.addWidget(self.slice_lbl)
+        layout.addWidget(self.slider)
+        self.setLayout(layout)
+
+        #Start at the slice with the most dose
+        self.slider.setValue(int(np.argmax(grid.dose.sum(axis=(1,2)))))
+        self.show_slice(self.slider.value())
 
+    def show_slice(self, k):
+        self.image.set_data(self.grid.dose[k])
+        self.axes.set_title("Z = %.1f mm" % self.z[k])
+        self.slice_lbl.setText("Slice %d/%d" % (k+1, len(self.z)))
+        self.canvas.draw_idle()
 
 
 class Window(QWidget):
@@ -43,6 +117,7 @@ class Window(QWidget):
         mainLayout = QVBoxLayout()
         self.setGeometry(600,200,1000,800)
         self.flag = False
+        self.depth_step = 0.25 #cm, grid spacing for Bragg peak plots
         
         self.done_red = 'font-size: 18px; color: rgb(200,50,50)'
         self.done_blue = 'font-size: 18px; color: rgb(50,50,200)'
@@ -70,7 +145,8 @@ class Window(QWidget):
         dropdown = QComboBox(self)
         dropdown.setFixedHeight(20)
         self.phantom_path = './MGH_Phantoms/'
-        phantoms = gen1.get_phantom_list(self.phantom_path)
+        self.phantom_index = index.PhantomIndex(self.phantom_path)
+        phantoms = self.phantom_index.phantom_list()
         dropdown.addItem('Select Phantom')
         for name in phantoms:           
             dropdown.addItem(name)
@@ -178,6 +254,18 @@ class Window(QWidget):
         self.rtipLayout.addWidget(dataLoadBtn)
         self.rtipLayout.addWidget(self.chkbox)
         self.rtipLayout.addWidget(self.chkbox2)
+
+        #Approximate 3D dose of the loaded spot map over the selected phantom
+        dose_btn = QPushButton("3D dose")
+        dose_btn.setFixedHeight(30)
+        dose_btn.clicked.connect(self.compute_dose3d)
+        self.rtipLayout.addWidget(dose_btn)
+
+        #Differences between the loaded spot map and the phantom plan
+        compare_btn = QPushButton("Compare with phantom plan")
+        compare_btn.setFixedHeight(30)
+        compare_btn.clicked.connect(self.compare_plans)
+        self.rtipLayout.addWidget(compare_btn)
                 
         # Add space for spot map statistics
         self.loadstatus = QLabel()
@@ -189,28 +277,57 @@ class Window(QWidget):
         
         self.rtipLayout.addWidget(self.loadstatus)
         self.rtipLayout.addWidget(self.csv_stats) 
+
+        #Timings of the generation/upload stages, hidden unless asked for
+        self.trace_chkbox = QCheckBox("Show stage timings")
+        self.trace_chkbox.toggled.connect(self.toggle_trace)
+        self.trace_text = QTextEdit()
+        self.trace_text.setReadOnly(True)
+        self.trace_text.setStyleSheet("font-family: monospace; font-size: 11px")
+        self.trace_text.hide()
+        self.rtipLayout.addWidget(self.trace_chkbox)
+        self.rtipLayout.addWidget(self.trace_text)
+        self.trace_signals = jobs.TraceSignals()
+        self.trace_signals.span.connect(self.show_span)
+        trace.add_listener(self.trace_signals.span.emit)
         
         
         #Third pane
         plotWidget = QWidget()
         plotLayout = QVBoxLayout()
         
-        #Make figures and navi toolbar
-        self.fig = Figure()
-        self.canvas = FigureCanvas(self.fig)
-        self.axes11 = self.fig.add_subplot(2,1,1)
-        self.axes12 = self.fig.add_subplot(2,1,2)
-        self.fig.tight_layout()
-        
-        navi_toolbar = NavigationToolbar(self.canvas,plotWidget)
-        plotLayout.addWidget(navi_toolbar)
-        plotLayout.addWidget(self.canvas,Qt.AlignHCenter)
+        #Figures and navi toolbar are made when there is something to plot (see init_plots)
+        self.plotWidget = plotWidget
+        self.plotLayout = plotLayout
+        self.fig = None
+        self.plot_placeholder = QLabel("Select a phantom or browse for a spot map")
+        self.plot_placeholder.setAlignment(Qt.AlignCenter)
+        plotLayout.addWidget(self.plot_placeholder,1)
+
+        #Layer browser: 0 shows all layers, n highlights layer n
+        self.layer_lbl = QLabel("Layer: all")
+        self.layer_slider = QSlider(Qt.Horizontal)
+        self.layer_slider.setRange(0, 0)
+        self.layer_slider.valueChanged.connect(self.show_layer)
+        plotLayout.addWidget(self.layer_lbl)
+        plotLayout.addWidget(self.layer_slider)
 
         #Done status        
         self.done_lbl = QLabel()
         self.done_lbl.setStyleSheet(self.done_green)
         self.done_lbl.setAlignment(Qt.AlignHCenter)
         doneLayout.addWidget(self.done_lbl)
+
+        #Progress of background jobs (generation/upload)
+        self.job_queue = jobs.JobQueue()
+        self.job_lbl = QLabel()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFixedWidth(200)
+        cancel_btn = QPushButton("Cancel")
+        cancel_btn.clicked.connect(self.cancel_jobs)
+        doneLayout.addWidget(self.job_lbl)
+        doneLayout.addWidget(self.progress_bar)
+        doneLayout.addWidget(cancel_btn)
         
         #Add widgets to main window
         paneLayout.addWidget(inputWidget)
@@ -222,6 +339,25 @@ class Window(QWidget):
         self.setLayout(mainLayout)
         
         self.show()
+
+    def init_plots(self):
+        """Makes the figure, canvas and toolbar on first use. matplotlib is first imported here"""
+
+        if self.fig is not None:
+            return
+
+        matplotlib.use("Qt5Agg")
+        self.fig = mpl_figure.Figure()
+        self.canvas = backend_qt5agg.FigureCanvasQTAgg(self.fig)
+        self.axes11 = self.fig.add_subplot(2,1,1)
+        self.axes12 = self.fig.add_subplot(2,1,2)
+        self.blit = plot.BlitManager(self.canvas)
+
+        navi_toolbar = backend_qt5agg.NavigationToolbar2QT(self.canvas,self.plotWidget)
+        self.plotLayout.removeWidget(self.plot_placeholder)
+        self.plot_placeholder.deleteLater()
+        self.plotLayout.insertWidget(0,navi_toolbar)
+        self.plotLayout.insertWidget(1,self.canvas,1)
                        
                 
     def onActivated(self,text):
@@ -234,21 +370,26 @@ class Window(QWidget):
         #Pull in RTIP from phantom set
         self.phantom_dir = self.phantom_path + text + '/'
         
-        #Get isocenter, gantry, and spot map
-        self.isocenter, self.gantry_angle, self.msg = gen1.get_isocenter(self.phantom_dir)
-        specs, mapy = gen1.plot_rtip_map(self.phantom_dir)
+        #Get isocenter, gantry, and spot map (cached until the phantom directory changes)
+        info = self.phantom_index.get(text)
+        self.isocenter, self.gantry_angle, self.msg = info['isocenter'], info['gantry_angle'], info['msg']
+        mapy = info['spot_map']
+        self.phantom_spots = mapy
 
         self.currentiso_lbl.setText("Current isocenter position: %s" % self.isocenter)
-        with open(specs, 'r') as f:
-            text = f.read()
-            self.spot_stats.setText(text)
-            self.spot_stats.setAlignment(Qt.AlignTop)
-        f.close()
+        self.spot_stats.setText(info['specs'])
+        self.spot_stats.setAlignment(Qt.AlignTop)
         
         #Plot spot map 
+        self.init_plots()
         self.axes11.clear()
         self.axes12.clear()
-        self.axes11.scatter(mapy[:,1], mapy[:,2])
+        self.blit.clear()
+        plot.draw_spots(self.axes11, mapy[:,1], mapy[:,2])
+        if _has_layer_columns(mapy):
+            self.setup_layers(mapy[:,0], mapy[:,1], mapy[:,2], mapy[:,3])
+        else:
+            self.clear_layers()
         self.axes11.set_title("Spot Map")
         self.axes11.set_xlabel("X(mm)")
         self.axes11.set_ylabel("Y(mm")
@@ -259,8 +400,10 @@ class Window(QWidget):
     def load_spot_map(self):
         
         #Clear plots
+        self.init_plots()
         self.axes11.clear()
         self.axes12.clear()
+        self.blit.clear()
         
         #Open file location        
         dlg = QFileDialog()
@@ -268,44 +411,35 @@ class Window(QWidget):
         self.spotmap = dlg.getOpenFileName(self, 'Select Spot Map CSV', '~./')
         self.current_wdir = os.path.dirname(self.spotmap[0])
        
-        #Get data
-        csv_msg = gen2.csv_check(self.spotmap[0])
+        #Get data. Csv is parsed once (or memory-mapped from the binary cache) and shared by the
+        #checks, plots and RTIP generation
+        loaded = cache.load_spotmap(self.spotmap[0], step=self.depth_step)
+        self.spots = loaded.spots
+        csv_msg = gen2.csv_check(self.spots)
         self.done_lbl.setText(csv_msg)
-        self.name, self.data, dose_array = gen2.dose_estimator(self.spotmap[0])
-        self.E_list = dose_array[:,0]
-        dose = dose_array[:,1]
+        self.stats = loaded.stats
+        self.name = self.spots.name
+        self.data = self.spots.columns()
+        self.E_list = loaded.dose_array[:,0]
                 
         #Update text box with statistics
-        with open(self.name + '.txt', 'r') as f:
-            file_text = f.read()
-            self.csv_stats.setText(file_text)
-            self.csv_stats.setAlignment(Qt.AlignTop)
-        f.close()
+        self.csv_stats.setText(gen2.format_stats(self.stats))
+        self.csv_stats.setAlignment(Qt.AlignTop)
 
         #Plot spot map 
-        self.axes11.scatter(self.data[:,1], self.data[:,2])
+        plot.draw_spots(self.axes11, self.data[:,1], self.data[:,2], weights=self.data[:,3])
+        self.setup_layers(self.data[:,0], self.data[:,1], self.data[:,2], self.data[:,3])
         self.axes11.set_title("Spot Map")
         self.axes11.set_xlabel("X(mm)")
         self.axes11.set_ylabel("Y(mm")
         
-        #Plot Bragg peaks. FIX TO MAKE MORE ROBUST WITH VARYING STEP SIZE
-        BP_sum = np.zeros((200))#dose at depth, column for each Bragg peak
-        for n,e in enumerate(self.E_list):
-            energy_vs_depth = gen2.E_depth(e)
-            self.axes12.plot(energy_vs_depth[:,0], energy_vs_depth[:,2]*dose[n], linewidth=1)
-            
-            # Find max depth for setting x-axis max
-            if n==0:
-                x_max = energy_vs_depth[-1,0]
-            
-            #sum bragg peaks
-            for m in range(energy_vs_depth.shape[0]):
-                BP_sum[m] += energy_vs_depth[m,2]*dose[n]
-                
+        #Plot Bragg peaks on a grid sized to the deepest layer in the plan
+        depth, BP_sum, layer_dose = loaded.depth, loaded.dose_sum, loaded.layer_dose
+        plot.draw_layer_curves(self.axes12, depth, layer_dose)
 
         # Plot data
-        self.axes12.plot(np.arange(0,len(BP_sum)/4,0.25), BP_sum, color='black')
-        self.axes12.set_xlim(0, x_max+2)
+        self.axes12.plot(depth, BP_sum, color='black')
+        self.axes12.set_xlim(0, depth[-1])
         self.axes12.set_title("Approximate Bragg Peaks (normalized to dose)")
         self.axes12.set_xlabel("Depth/Z (cm)")
         self.axes12.set_ylabel("Dose (arb)")
@@ -317,67 +451,195 @@ class Window(QWidget):
         self.loadstatus.setAlignment(Qt.AlignTop)
         
    
+    def setup_layers(self, energy, x, y, gp):
+        """Builds the layer index for the spot map on screen and the highlight drawn over it"""
+
+        self.layers = gen2.LayerIndex(energy, gp)
+        self.layer_xy = np.column_stack((x, y))
+        self.layer_scatter = self.axes11.scatter([], [], color='red', s=12)
+        self.blit.add_artist(self.layer_scatter)
+
+        self.layer_slider.blockSignals(True)
+        self.layer_slider.setRange(0, len(self.layers))
+        self.layer_slider.setValue(0)
+        self.layer_slider.blockSignals(False)
+        self.layer_lbl.setText("Layer: all (%d layers)" % len(self.layers))
+
+    def clear_layers(self):
+        """Turns the layer browser off for a spot map without energy/Gp columns"""
+
+        self.layer_slider.blockSignals(True)
+        self.layer_slider.setRange(0, 0)
+        self.layer_slider.blockSignals(False)
+        self.layer_lbl.setText("Layer: -")
+
+    def show_layer(self, value):
+        """Swaps the highlighted spots for the selected layer. Only the highlight is redrawn"""
+
+        if value == 0:
+            self.layer_scatter.set_offsets(self.layer_xy[:0])
+            self.layer_lbl.setText("Layer: all (%d layers)" % len(self.layers))
+        else:
+            n = value - 1
+            self.layer_scatter.set_offsets(self.layer_xy[self.layers.layer(n)])
+            self.layer_lbl.setText("Layer: %d/%d   Energy = %s MeV   Gp = %.4g" %
+                                   (value, len(self.layers), self.layers.energies[n], self.layers.gp[n]))
+        self.blit.update()
+
+    def compare_plans(self):
+        """Overlay of the loaded spot map on the phantom plan (moved/new spots highlighted) and Gp change per layer"""
+
+        if not hasattr(self, 'phantom_spots') or not hasattr(self, 'data'):
+            self.done_lbl.setText("Select a phantom and load a spot map first")
+            return
+        if not _has_layer_columns(self.phantom_spots):
+            self.done_lbl.setText("The phantom plan has no energy/Gp columns to compare against")
+            return
+
+        diff = compare.compare(self.phantom_spots, self.data)
+        self.csv_stats.setText(compare.format_diff(diff, max_layers=15))
+
+        #Top: phantom plan in grey, loaded spots that moved (red) or are in new layers (blue)
+        self.axes11.clear()
+        self.axes12.clear()
+        self.blit.clear()
+        plot.draw_spots(self.axes11, self.phantom_spots[:,1], self.phantom_spots[:,2], color='lightgrey', s=4,
+                        cmap='Greys')
+        moved = np.flatnonzero(diff.shift > compare.POSITION_TOL)
+        moved = moved[np.argsort(diff.shift[moved])[::-1][:plot.MAX_SCATTER]]
+        new = moved[np.isinf(diff.shift[moved])]
+        shifted = moved[np.isfinite(diff.shift[moved])]
+        self.axes11.scatter(self.data[shifted,1], self.data[shifted,2], color='red', s=6, label='moved')
+        self.axes11.scatter(self.data[new,1], self.data[new,2], color='blue', s=6, label='new layer')
+        self.axes11.legend(loc='upper right', fontsize='small')
+        self.axes11.set_title("Loaded vs phantom plan")
+        self.axes11.set_xlabel("X(mm)")
+        self.axes11.set_ylabel("Y(mm")
+        self.setup_layers(self.data[:,0], self.data[:,1], self.data[:,2], self.data[:,3])
+
+        #Bottom: Gp change per layer
+        energies = np.array([l.energy for l in diff.layers])
+        delta_gp = np.array([l.gp_b - l.gp_a for l in diff.layers])
+        width = 0.8*np.diff(np.sort(energies)).min() if len(energies) > 1 else 1.0
+        self.axes12.bar(energies, delta_gp, width=width, color=np.where(delta_gp < 0, 'red', 'green'))
+        self.axes12.axhline(0, color='black', linewidth=0.5)
+        self.axes12.set_title("Gp change per layer (loaded - phantom)")
+        self.axes12.set_xlabel("Energy (MeV)")
+        self.axes12.set_ylabel("Gp")
+        self.fig.tight_layout()
+        self.canvas.draw()
+
+    def compute_dose3d(self):
+        if not hasattr(self, 'phantom_dir') or not hasattr(self, 'data'):
+            self.done_lbl.setText("Select a phantom and load a spot map first")
+            return
+
+        #Same geometry Generate would use: text boxes, otherwise the selected phantom
+        if self.le_x.text() and self.le_y.text() and self.le_z.text():
+            isocenter = [self.le_x.text(), self.le_y.text(), self.le_z.text()]
+        else:
+            isocenter = self.isocenter
+        angle = self.gantry.text() or self.gantry_angle
+
+        job = jobs.Dose3DJob("Dose %s" % self.name, self.phantom_dir, self.data, isocenter, angle)
+        job.signals.progress.connect(self.job_progress)
+        job.signals.finished.connect(self.dose3d_done)
+        job.signals.failed.connect(self.job_failed)
+        self.job_queue.submit(job)
+        self.done_lbl.setText("Queued: %s" % job.name)
+
+    def dose3d_done(self, name, grid):
+        self.progress_bar.setMaximum(1)
+        self.progress_bar.setValue(1)
+        self.init_plots()
+        self.dose_viewer = DoseViewer(grid, name)
+        self.dose_viewer.show()
+
     def generate_dicom(self):
-     
-        #Generate new RTIP from csv
+
+        if not hasattr(self, 'phantom_dir'):
+            self.done_lbl.setText("No phantom directory selected!")
+            return 0
+
+        #Generate new RTIP from csv, otherwise use old treatment plan
+        csv_file = None
+        setup = False
         if self.chkbox.isChecked():
-            csv_file = self.spotmap[0]
-            if self.chkbox2.isChecked():
-                setup = True
-            else:
-                setup = False
-            
-            try:
-                ct_directory,fgs,ibs = gen2.gen_rtip(csv_file, self.phantom_dir,setup)
-                print(ct_directory)
-
-            except:
-                self.done_lbl.setText("Could not process csv. Please check that format is correct")
-                
-        #If no new csv, use old treatment plan
-        else:
-            try:
-                ct_directory = self.phantom_dir
-                fgs = None
-                ibs = None
-            except:
-                self.done_lbl.setText("No phantom directory selected!")
-                return 0
-            
+            csv_file = self.spots
+            setup = self.chkbox2.isChecked()
+
         #Name
         fname = self.patientfirstname.text()
         lname = self.patientlastname.text()
-        
-        #Create new dicom set and print done message
-        try:
-            self.new_dir, done_msg = gen3.gen_dicom(fname,lname,ct_directory)
-            self.upload_btn.setStyleSheet(self.done_green)
-            self.flag = True
-        except:
-            done_msg = "Could not generate new dicom set. Check Python log"
-            
+
+        #If text boxes filled, use those values, otherwise keep isocenter/gantry from selected phantom
+        geometry = [self.le_x.text(), self.le_y.text(), self.le_z.text(), self.gantry.text()]
+        x, y, z, angle = [value or None for value in geometry]
+
+        #Create new dicom set in the background
+        job = jobs.GenerateJob("Generate %s_%s" % (fname, lname), self.phantom_dir, fname, lname,
+                               csv_file=csv_file, setup=setup, x=x, y=y, z=z, angle=angle)
+        job.signals.progress.connect(self.job_progress)
+        job.signals.finished.connect(self.generate_done)
+        job.signals.failed.connect(self.job_failed)
+        self.job_queue.submit(job)
+        self.done_lbl.setText("Queued: %s" % job.name)
+
+    def generate_done(self, name, workspace):
+        #Session stays in memory until it has been uploaded
+        self.workspace = workspace
+        self.new_dir, done_msg = workspace.new_dir, workspace.done_msg
+        self.upload_btn.setStyleSheet(self.done_green)
+        self.flag = True
+        self.progress_bar.setMaximum(1)
+        self.progress_bar.setValue(1)
         self.done_lbl.setText(done_msg)
-        
-        #If text boxes filled, use those values, otherwise copy isocenter only from selected phantom
-        if self.le_x.text() or self.gantry.text():
-            gen3.replace_iso_gantry_spots(self.new_dir,
-                                   self.le_x.text(),self.le_y.text(),self.le_z.text(),
-                                   self.gantry.text(),fgs,ibs)
-        else:
-            self.gantry_angle = None
-            gen3.replace_iso_gantry_spots(self.new_dir,
-                                   self.isocenter[0],self.isocenter[1],self.isocenter[2],
-                                   self.gantry_angle,fgs,ibs)
 
-        
     def upload_to_WB(self):
         if self.flag == False:
             self.done_lbl.setText("Cannot upload to Whiteboard")
         else:
-            upload_msg = gen3.upload(self.new_dir)
-            self.done_lbl.setText(upload_msg)
+            job = jobs.UploadJob("Upload %s" % self.new_dir, self.new_dir, workspace=getattr(self, 'workspace', None))
+            job.signals.progress.connect(self.job_progress)
+            job.signals.throughput.connect(self.job_throughput)
+            job.signals.finished.connect(lambda name, results, job=job: self.upload_done(job, results))
+            job.signals.failed.connect(self.job_failed)
+            self.job_queue.submit(job)
+            self.done_lbl.setText("Queued: %s" % job.name)
+
+    def upload_done(self, job, results):
+        self.progress_bar.setMaximum(1)
+        self.progress_bar.setValue(1)
+        self.done_lbl.setText(Dicom_upload.format_results(results))
+        #The job released the session it uploaded, which may not be the last one generated
+        if job.released and job.workspace is getattr(self, 'workspace', None):
+            self.workspace = None
+
+    def job_progress(self, name, message, done, total):
+        #total of 0 means the step has no file count: show a busy bar
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.job_lbl.setText("%s: %s" % (name, message))
+
+    def job_throughput(self, name, destination, f, MB_per_s):
+        self.job_lbl.setText("%s: %s %s (%.1f MB/s)" % (name, destination, f, MB_per_s))
+
+    def job_failed(self, name, message):
+        self.done_lbl.setText("%s failed: %s" % (name, message))
+
+    def cancel_jobs(self):
+        self.job_queue.cancel_all()
+        self.job_lbl.setText("Cancelling: %s" % ', '.join(self.job_queue.running()))
+
+    def toggle_trace(self, checked):
+        self.trace_text.setVisible(checked)
+
+    def show_span(self, span):
+        #Spans finish innermost first, so stages are listed before the session/upload total
+        indent = '  ' if span.parent is not None else ''
+        self.trace_text.append(indent + str(span))
+
 
-        
 #This bit to prevent kernal from dying. Taken from stack overflow. Works only part of the time
 if __name__ == '__main__':
 
@@ -385,10 +647,17 @@ if __name__ == '__main__':
         app = QApplication(sys.argv)
     else:
         app = QApplication.instance() 
-        
-        
-a_window = Window() #Now create instance of window class
-sys.exit(app.exec_())
+
+    a_window = Window() #Now create instance of window class
+
+    #Startup benchmark: report the time to the first paint of the window and quit
+    if '--time-startup' in sys.argv:
+        def report_startup():
+            print('startup_seconds %.4f' % (time.perf_counter() - _start))
+            app.quit()
+        QTimer.singleShot(0, report_startup)
+
+    sys.exit(app.exec_())
         
         
                 
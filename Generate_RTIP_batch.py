@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch generation of treatment sessions from a manifest.
+
+Each manifest row is one session. Columns (CSV header or YAML keys):
+    first_name, last_name, phantom   required
+    session                          session directory (optional, default first_last)
+    csv                              spot map for a new plan (optional)
+    setup                            first beam is the setup beam (optional)
+    x, y, z, gantry                  new isocenter (mm) and gantry angle (optional)
+    upload                           upload the session when done (optional)
+
+Rows for the same patient without a session column (e.g. the same plan at several gantry angles)
+get first_last_<row> so parallel workers never share a session directory. Unknown columns and
+repeated session names are rejected before anything runs.
+
+Usage:
+    python Generate_RTIP_batch.py manifest.csv --workers 4 --report report.csv
+
+"""
+
+import os
+import sys
+import csv
+import copy
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import Generate_RTIP_func2 as gen2
+import Generate_RTIP_func3 as gen3
+
+
+FIELDS = ['first_name', 'last_name', 'phantom', 'session', 'csv', 'setup', 'x', 'y', 'z', 'gantry', 'upload']
+REQUIRED_FIELDS = ['first_name', 'last_name', 'phantom']
+REPORT_FIELDS = ['row', 'session', 'status', 'seconds', 'message']
+
+#Plans already built in this worker, keyed by (csv, setup)
+_plans = {}
+
+
+def _flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def _value(row, key):
+    value = row.get(key)
+    if value is None or str(value).strip() == '':
+        return None
+    return str(value).strip()
+
+
+def read_manifest(file):
+    """Reads the manifest rows as a list of dicts. YAML needs PyYAML, anything else is read as CSV"""
+
+    if file.lower().endswith(('.yml', '.yaml')):
+        import yaml
+        with open(file, 'r') as f:
+            rows = yaml.safe_load(f) or []
+    else:
+        with open(file, 'r') as f:
+            rows = list(csv.DictReader(f))
+
+    return [dict((k.strip(), v) for k,v in row.items()) for row in rows]
+
+
+def session_names(rows):
+    """Session directory of every manifest row. Raises ValueError for unknown or missing columns
+    and for session names used by more than one row"""
+
+    for n,row in enumerate(rows, 1):
+        unknown = sorted(set(row) - set(FIELDS))
+        if unknown:
+            raise ValueError("Row %d: unknown manifest columns %s" % (n, ', '.join(unknown)))
+        missing = [k for k in REQUIRED_FIELDS if _value(row, k) is None]
+        if missing:
+            raise ValueError("Row %d: missing %s" % (n, ', '.join(missing)))
+
+    #Patients with several rows get one directory per row unless the rows name their sessions
+    default = ['%s_%s' % (_value(row, 'first_name'), _value(row, 'last_name')) for row in rows]
+    names = []
+    for n,row in enumerate(rows, 1):
+        if _value(row, 'session') is not None:
+            names.append(_value(row, 'session'))
+        elif default.count(default[n-1]) > 1:
+            names.append('%s_%d' % (default[n-1], n))
+        else:
+            names.append(default[n-1])
+
+    repeated = sorted(set(name for name in names if names.count(name) > 1))
+    if repeated:
+        raise ValueError("Session names used by more than one row: %s" % ', '.join(repeated))
+
+    return names
+
+
+def _plan(csv_file, setup):
+    """Builds a spot map's plan once per worker and hands out copies of its beam sequences"""
+
+    key = (csv_file, setup)
+    if key not in _plans:
+        _plans[key] = gen2.plan_sequences(csv_file, setup)
+
+    return copy.deepcopy(_plans[key])
+
+
+def run_row(n, row, phantom_path='./MGH_Phantoms/', session=None):
+    """Generates (and optionally uploads) the session for one manifest row. Returns a report dict"""
+
+    start = time.time()
+    session = session or _value(row, 'session') or '%s_%s' % (_value(row, 'first_name'), _value(row, 'last_name'))
+    report = {'row': n, 'session': session, 'status': 'ok', 'message': ''}
+
+    try:
+        phantom_dir = os.path.join(phantom_path, _value(row, 'phantom')) + '/'
+        csv_file = _value(row, 'csv')
+        plan = _plan(csv_file, _flag(row.get('setup'))) if csv_file else None
+
+        workspace = gen3.build_session(phantom_dir, _value(row, 'first_name'), _value(row, 'last_name'),
+                                       x=_value(row, 'x'), y=_value(row, 'y'), z=_value(row, 'z'),
+                                       angle=_value(row, 'gantry'), plan=plan, session=session)
+        report['message'] = workspace.done_msg
+
+        #Upload straight from memory, then let the series go before the next row
+        if _flag(row.get('upload')):
+            results = workspace.upload()
+            report['message'] = gen3.format_results(results).replace('\n', '; ')
+            if not all(r.ok for r in results.values()):
+                report['status'] = 'failed'
+
+        workspace.release()
+
+    except Exception as e:
+        report['status'] = 'failed'
+        report['message'] = '%s: %s' % (type(e).__name__, e)
+
+    report['seconds'] = round(time.time() - start, 3)
+
+    return report
+
+
+def run_batch(rows, phantom_path='./MGH_Phantoms/', workers=None):
+    """Runs every manifest row across a process pool. Reports come back in manifest order"""
+
+    names = session_names(rows)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(run_row, n, row, phantom_path, name) for n,(row,name) in enumerate(zip(rows, names), 1)]
+        reports = [job.result() for job in jobs]
+
+    return reports
+
+
+def write_report(reports, file):
+    with open(file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(reports)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate treatment sessions from a manifest')
+    parser.add_argument('manifest', help='CSV or YAML manifest, one session per row')
+    parser.add_argument('--phantoms', default='./MGH_Phantoms/', help='phantom directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--report', default=None, help='write per-row timing and status to this CSV')
+    args = parser.parse_args(argv)
+
+    rows = read_manifest(args.manifest)
+    try:
+        session_names(rows)
+    except ValueError as e:
+        print('Manifest error: %s' % e)
+        return 2
+    reports = run_batch(rows, args.phantoms, args.workers)
+
+    for r in reports:
+        print('%(row)4d  %(session)-30s %(status)-7s %(seconds)8.2fs  %(message)s' % r)
+    if args.report:
+        write_report(reports, args.report)
+
+    return 0 if all(r['status'] == 'ok' for r in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache for parsed spot maps.
+
+The first load of a csv parses it and saves the spot array, per-layer [energy, Gp] totals and
+the depth-dose curves as .npy files in a directory named after the csv's SHA-1. Later loads
+of the same content (any path) memory-map those files read-only instead of parsing text, so
+several processes can share the same pages.
+
+The first load in each process prunes the cache: entries written by another CACHE_VERSION,
+entries not used for MAX_AGE_DAYS and, past MAX_CACHE_BYTES, the least recently used ones.
+
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from collections import namedtuple
+
+import Generate_RTIP_func2 as gen2
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'TreatmentPlanGUI', 'spotmaps')
+CACHE_VERSION = 3
+
+#Pruning limits
+MAX_CACHE_BYTES = 2*1024**3
+MAX_AGE_DAYS = 30
+
+#Everything load_spot_map needs for one spot map
+CachedSpotMap = namedtuple('CachedSpotMap', ['spots', 'dose_array', 'stats', 'depth', 'dose_sum', 'layer_dose'])
+
+ARRAYS = ['data', 'dose_array', 'energies', 'depth', 'dose_sum', 'layer_dose']
+
+
+def file_hash(file):
+    """SHA-1 of the file contents"""
+
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _parse(file, step):
+    spots = gen2.SpotMap.from_csv(file)
+    name, data, dose_array, stats = gen2.dose_estimator(spots)
+    depth, dose_sum, layer_dose = gen2.depth_dose_sum(dose_array[:,0], dose_array[:,1], step=step)
+
+    return CachedSpotMap(spots, dose_array, stats, depth, dose_sum, layer_dose)
+
+
+def _save(entry, result, step):
+    """Writes the arrays into a temporary directory and renames it into place"""
+
+    parent = os.path.dirname(entry)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        arrays = {'data': result.spots.data, 'dose_array': result.dose_array, 'energies': result.stats.energies,
+                  'depth': result.depth, 'dose_sum': result.dose_sum, 'layer_dose': result.layer_dose}
+        for key,value in arrays.items():
+            np.save(os.path.join(tmp_dir, key + '.npy'), np.ascontiguousarray(value))
+
+        meta = {'version': CACHE_VERSION, 'step': step, 'num_spots': int(result.stats.num_spots),
+                'num_layers': int(result.stats.num_layers), 'total_Gp': float(result.stats.total_Gp),
+                'skipped': int(result.spots.skipped)}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        #A damaged entry or one from another cache version is in the way: replace it
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_dir, entry)
+    except OSError:
+        #Another process got there first, or the cache isn't writable
+        pass
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _load(entry, file):
+    with open(os.path.join(entry, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        return None, None
+
+    arrays = dict((key, np.load(os.path.join(entry, key + '.npy'), mmap_mode='r')) for key in ARRAYS)
+    spots = gen2.SpotMap(arrays['data'], file, meta.get('skipped', 0))
+    stats = gen2.SpotMapStats(name=spots.name, num_spots=meta['num_spots'], num_layers=meta['num_layers'],
+                              total_Gp=meta['total_Gp'], energies=arrays['energies'])
+    result = CachedSpotMap(spots, arrays['dose_array'], stats, arrays['depth'], arrays['dose_sum'], arrays['layer_dose'])
+
+    return result, meta['step']
+
+
+def _entry_version(entry):
+    try:
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            return json.load(f).get('version')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def _entry_size(entry):
+    return sum(e.stat().st_size for e in os.scandir(entry) if e.is_file())
+
+
+def prune(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, max_age_days=MAX_AGE_DAYS):
+    """Deletes entries of other cache versions, entries unused for max_age_days and then the least
+    recently used entries until the cache is under max_bytes. An entry's mtime is its last use.
+    Returns the number of entries deleted"""
+
+    try:
+        entries = [e for e in os.scandir(cache_dir) if e.is_dir()]
+    except OSError:
+        return 0
+
+    now = time.time()
+    keep = []
+    deleted = 0
+    for e in entries:
+        age = now - e.stat().st_mtime
+        if e.name.startswith('tmp'):
+            #Left behind by a writer that died; a live one finishes well within a day
+            stale = age > 86400
+        else:
+            stale = _entry_version(e.path) != CACHE_VERSION or age > max_age_days*86400
+        if stale:
+            shutil.rmtree(e.path, ignore_errors=True)
+            deleted += 1
+        elif not e.name.startswith('tmp'):
+            keep.append((e.stat().st_mtime, _entry_size(e.path), e.path))
+
+    total = sum(size for mtime,size,path in keep)
+    for mtime,size,path in sorted(keep):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        deleted += 1
+
+    return deleted
+
+
+_pruned = set()
+
+def load_spotmap(file, step=0.25, cache_dir=CACHE_DIR):
+    """Returns a CachedSpotMap for a csv, from the binary cache when the same content was loaded before"""
+
+    if cache_dir not in _pruned:
+        _pruned.add(cache_dir)
+        prune(cache_dir)
+
+    entry = os.path.join(cache_dir, file_hash(file))
+
+    result = None
+    try:
+        result, cached_step = _load(entry, file)
+        if result is not None:
+            #Mark as recently used for pruning
+            os.utime(entry)
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    if result is None:
+        result = _parse(file, step)
+        _save(entry, result, step)
+
+    #Depth curves are cached for one grid step only; other steps are cheap to recompute
+    elif cached_step != step:
+        depth, dose_sum, layer_dose = gen2.depth_dose_sum(result.dose_array[:,0], result.dose_array[:,1], step=step)
+        result = result._replace(depth=depth, dose_sum=dose_sum, layer_dose=layer_dose)
+
+    return result
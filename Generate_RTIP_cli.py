@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Command line entry point and Python API for the plan pipeline, without the GUI.
+
+Nothing here imports Qt or matplotlib, and the pipeline modules (dicom, paramiko, ...) are
+only imported by the command that needs them, so the script starts quickly and is safe to
+call from cron jobs and worker processes.
+
+Usage:
+    python Generate_RTIP_cli.py generate PHANTOM FIRST LAST [--csv map.csv] [--setup]
+                                         [--iso X Y Z] [--gantry ANGLE] [--upload]
+    python Generate_RTIP_cli.py upload SESSION_DIR [--workers 4] [--no-resume]
+    python Generate_RTIP_cli.py stats map.csv
+
+--trace FILE (before the command) appends the timed stages of the run to FILE as JSON lines.
+
+As a library:
+    import Generate_RTIP_cli as rtip
+    new_dir, msg = rtip.generate('Head', 'Jane', 'Doe', csv_file='map.csv', angle=90)
+    results = rtip.upload(new_dir)
+
+    workspace = rtip.build('Head', 'Jane', 'Smith', csv_file='map.csv')   #keeps the session in memory
+    results = workspace.upload()                                        #sent without reading it back
+
+"""
+
+import os
+import sys
+import argparse
+
+
+PHANTOM_PATH = './MGH_Phantoms/'
+
+
+def generate(phantom, fname, lname, csv_file=None, setup=False, x=None, y=None, z=None, angle=None,
+             phantom_path=PHANTOM_PATH, progress=None, cancel=None):
+    """Clones a phantom into a new session, optionally with a new plan from a spot map csv and a new
+    isocenter (mm) / gantry angle. Returns (session directory, message)"""
+
+    workspace = build(phantom, fname, lname, csv_file, setup, x, y, z, angle, phantom_path, progress, cancel)
+    workspace.release()
+
+    return workspace.new_dir, workspace.done_msg
+
+
+def build(phantom, fname, lname, csv_file=None, setup=False, x=None, y=None, z=None, angle=None,
+          phantom_path=PHANTOM_PATH, progress=None, cancel=None):
+    """generate, returning the SessionWorkspace (written to disk and still in memory) so that
+    workspace.upload() sends the session without reading it back"""
+
+    import Generate_RTIP_func3 as gen3
+
+    phantom_dir = os.path.join(phantom_path, phantom) + '/'
+    return gen3.build_session(phantom_dir, fname, lname, csv_file, setup, x, y, z, angle,
+                              progress=progress, cancel=cancel)
+
+
+def build_plan(csv_file, setup=False):
+    """(FractionGroupSequence, IonBeamSequence) for a spot map csv, from the clinical csv2xml converter"""
+
+    import Generate_RTIP_func2 as gen2
+
+    return gen2.plan_sequences(csv_file, setup)
+
+
+def patch_plan(session_dir, x=None, y=None, z=None, angle=None, plan=None):
+    """Sets the isocenter, gantry angle and (optionally) beam sequences of a session's RTIP in place"""
+
+    import Generate_RTIP_func3 as gen3
+
+    fgs, ibs = plan if plan is not None else (None, None)
+    gen3.replace_iso_gantry_spots(session_dir, x, y, z, angle, fgs, ibs)
+
+
+def upload(session_dir, workers=4, resume=True, progress=None, cancel=None):
+    """Uploads a session to PACS and WB. Returns {destination: TransferResult}"""
+
+    import Dicom_upload
+
+    return Dicom_upload.upload(session_dir, workers, resume, progress=progress, cancel=cancel)
+
+
+def spot_map_stats(csv_file):
+    """SpotMapStats (spots, layers, total Gp, energies) of a spot map csv"""
+
+    import Generate_RTIP_func2 as gen2
+
+    name, data, dose_array, stats = gen2.dose_estimator(csv_file)
+    return stats
+
+
+def _print_progress(message, done, total):
+    if total:
+        print('%s (%d/%d)' % (message, done, total))
+    else:
+        print(message)
+
+
+def _generate(args):
+    x, y, z = args.iso if args.iso else (None, None, None)
+    workspace = build(args.phantom, args.first_name, args.last_name, args.csv, args.setup, x, y, z,
+                      args.gantry, args.phantoms, progress=None if args.quiet else _print_progress)
+    print(workspace.done_msg)
+    if not args.upload:
+        return 0
+
+    import Dicom_upload
+    results = workspace.upload()
+    print(Dicom_upload.format_results(results))
+    return 0 if all(r.ok for r in results.values()) else 1
+
+
+def _upload(args):
+    import Dicom_upload
+
+    results = upload(args.session_dir, args.workers, not args.no_resume)
+    print(Dicom_upload.format_results(results))
+    return 0 if all(r.ok for r in results.values()) else 1
+
+
+def _stats(args):
+    import Generate_RTIP_func2 as gen2
+
+    print(gen2.format_stats(spot_map_stats(args.csv)))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate and upload treatment sessions without the GUI')
+    parser.add_argument('--trace', default=None, help='append stage timings to this file as JSON lines')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('generate', help='clone a phantom into a new session')
+    p.add_argument('phantom', help='phantom name (directory under --phantoms)')
+    p.add_argument('first_name')
+    p.add_argument('last_name')
+    p.add_argument('--phantoms', default=PHANTOM_PATH, help='phantom directory')
+    p.add_argument('--csv', default=None, help='spot map for a new plan')
+    p.add_argument('--setup', action='store_true', help='first beam is the setup beam')
+    p.add_argument('--iso', nargs=3, metavar=('X', 'Y', 'Z'), default=None, help='new isocenter (mm)')
+    p.add_argument('--gantry', default=None, help='new gantry angle')
+    p.add_argument('--upload', action='store_true', help='upload the session when done')
+    p.add_argument('--quiet', action='store_true', help='no progress messages')
+    p.set_defaults(func=_generate)
+
+    p = commands.add_parser('upload', help='upload a session to PACS and WB')
+    p.add_argument('session_dir')
+    p.add_argument('--workers', type=int, default=4, help='SFTP channels to PACS')
+    p.add_argument('--no-resume', action='store_true', help='send every file again')
+    p.set_defaults(func=_upload)
+
+    p = commands.add_parser('stats', help='print spot map statistics')
+    p.add_argument('csv')
+    p.set_defaults(func=_stats)
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        import Generate_RTIP_trace as trace
+        trace.set_output(args.trace)
+
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Layer by layer comparison of two spot maps (e.g. the phantom plan and a loaded csv).
+
+Both plans are indexed once by energy (spots sorted so each energy is one contiguous slice).
+Layers are paired by energy and every spot of the new plan is matched to the nearest spot of
+the same layer in the reference plan, using scipy's cKDTree when scipy is installed and a
+chunked brute-force search otherwise. Per layer the report gives spot counts, Gp totals and
+how far spots moved; per spot it gives the distance to its match for the overlay plot.
+
+"""
+
+import numpy as np
+from collections import namedtuple
+
+import Generate_RTIP_func2 as gen2
+
+
+#Energies closer than this (MeV) are the same layer
+ENERGY_TOL = 0.05
+
+#Spots closer than this (mm) to their match count as unchanged
+POSITION_TOL = 0.5
+
+#Per layer comparison. Shifts in mm, None when the layer is missing from one plan
+LayerDiff = namedtuple('LayerDiff', ['energy', 'spots_a', 'spots_b', 'gp_a', 'gp_b', 'mean_shift', 'max_shift', 'moved'])
+
+#layers: LayerDiff per energy. shift: distance (mm) from each spot of plan b to its match in plan a
+#(inf if its layer is missing from a), in the order of the b spots
+PlanDiff = namedtuple('PlanDiff', ['layers', 'shift'])
+
+
+class PlanIndex(object):
+    """Spots (columns E, x, y, Gp) sorted by energy, with one slice per energy"""
+
+    def __init__(self, spots, energy_tol=ENERGY_TOL):
+        spots = np.asarray(spots, dtype=float)
+        keys = np.round(spots[:,0]/energy_tol).astype(np.int64)
+        self.order = np.argsort(keys, kind='stable')
+        self.spots = spots[self.order]
+
+        sorted_keys = keys[self.order]
+        starts = gen2.layer_starts(sorted_keys)
+        stops = np.append(starts[1:], len(sorted_keys)).astype(int)
+        self.layers = dict((int(sorted_keys[s]), slice(s, e)) for s,e in zip(starts, stops))
+        self.energy_tol = energy_tol
+
+    def layer(self, key):
+        """Spots of one energy key (empty array if the plan doesn't have it)"""
+        s = self.layers.get(key)
+        return self.spots[s] if s is not None else self.spots[:0]
+
+
+_cKDTree = []
+
+def _kdtree():
+    """scipy's cKDTree, or None without scipy. The import is only tried once"""
+    if not _cKDTree:
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        _cKDTree.append(cKDTree)
+    return _cKDTree[0]
+
+
+def nearest(ref_xy, xy, max_pairs=1000000):
+    """Distance from each point in xy to its nearest point in ref_xy"""
+
+    if len(ref_xy) == 0:
+        return np.full(len(xy), np.inf)
+
+    cKDTree = _kdtree()
+    if cKDTree is not None:
+        return cKDTree(ref_xy).query(xy)[0]
+
+    #Brute force, a chunk of points at a time so the distance matrix stays small.
+    #|p - r|^2 = |p|^2 + |r|^2 - 2 p.r puts the work in one matrix product per chunk
+    chunk = max(1, max_pairs//len(ref_xy))
+    ref_sq = (ref_xy**2).sum(axis=1)
+    dist = np.empty(len(xy))
+    for n in range(0, len(xy), chunk):
+        block = xy[n:n+chunk]
+        d2 = ref_sq[None,:] - 2*np.dot(block, ref_xy.T)
+        dist[n:n+chunk] = np.sqrt(np.maximum(d2.min(axis=1) + (block**2).sum(axis=1), 0))
+
+    return dist
+
+
+def compare(spots_a, spots_b, energy_tol=ENERGY_TOL, position_tol=POSITION_TOL):
+    """Compares plan b against reference plan a (arrays with columns E, x, y, Gp). Returns a PlanDiff"""
+
+    a = PlanIndex(spots_a, energy_tol)
+    b = PlanIndex(spots_b, energy_tol)
+
+    shift_sorted = np.full(len(b.spots), np.inf)
+    layers = []
+    for key in sorted(set(a.layers) | set(b.layers), reverse=True):
+        layer_a = a.layer(key)
+        layer_b = b.layer(key)
+        energy = (layer_b if len(layer_b) else layer_a)[0,0]
+
+        mean_shift = max_shift = None
+        moved = 0
+        if len(layer_a) and len(layer_b):
+            dist = nearest(layer_a[:,1:3], layer_b[:,1:3])
+            shift_sorted[b.layers[key]] = dist
+            mean_shift = float(dist.mean())
+            max_shift = float(dist.max())
+            moved = int((dist > position_tol).sum())
+        else:
+            moved = len(layer_b)
+
+        layers.append(LayerDiff(energy, len(layer_a), len(layer_b), float(layer_a[:,3].sum()),
+                                float(layer_b[:,3].sum()), mean_shift, max_shift, moved))
+
+    #Back to the order of the b spots
+    shift = np.empty_like(shift_sorted)
+    shift[b.order] = shift_sorted
+
+    return PlanDiff(layers, shift)
+
+
+def format_diff(diff, max_layers=None):
+    """Text summary: totals and the layers that differ (at most max_layers of them)"""
+
+    def identical(l):
+        return l.spots_a == l.spots_b and l.moved == 0 and abs(l.gp_a - l.gp_b) <= 1e-9*max(1.0, abs(l.gp_a))
+
+    lines = []
+    lines.append("Layers: %d compared, %d identical" % (len(diff.layers), sum(identical(l) for l in diff.layers)))
+    lines.append("Spots: %d -> %d, Gp: %.4g -> %.4g" % (sum(l.spots_a for l in diff.layers), sum(l.spots_b for l in diff.layers),
+                                                         sum(l.gp_a for l in diff.layers), sum(l.gp_b for l in diff.layers)))
+    changed = [l for l in diff.layers if not identical(l)]
+    if max_layers is not None and len(changed) > max_layers:
+        lines.append("(first %d of %d changed layers)" % (max_layers, len(changed)))
+        changed = changed[:max_layers]
+    for l in changed:
+        if l.spots_a == 0:
+            lines.append("%7.1f MeV: new layer (%d spots, Gp %.4g)" % (l.energy, l.spots_b, l.gp_b))
+        elif l.spots_b == 0:
+            lines.append("%7.1f MeV: removed (%d spots, Gp %.4g)" % (l.energy, l.spots_a, l.gp_a))
+        else:
+            lines.append("%7.1f MeV: spots %+d, Gp %+.4g, %d moved (mean %.2f mm, max %.2f mm)" %
+                         (l.energy, l.spots_b - l.spots_a, l.gp_b - l.gp_a, l.moved, l.mean_shift, l.max_shift))
+
+    return '\n'.join(lines)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate 3D dose of a spot map on a grid covering the phantom CT.
+
+Each energy layer contributes (lateral fluence) x (depth-dose curve):
+    - fluence: spots binned by Gp on a plane through the isocenter perpendicular to the beam
+      (spot X along the gantry rotation plane, spot Y along the couch axis), smoothed by a
+      separable Gaussian of width sigma
+    - depth-dose: energy lost per bin from the range table (Generate_RTIP_physics), with depth
+      measured in water along the beam direction (-sin(gantry), cos(gantry), 0) from where the
+      beam enters the grid. CT densities, beam divergence and nuclear losses are ignored.
+
+Layers are summed into a (depth, u, v) table one chunk of layers at a time (optionally on a
+process pool), then every voxel looks its dose up in that table, a few CT slices at a time.
+Memory is bounded by the table and one chunk of slices, not by the number of spots or layers.
+
+"""
+
+import os
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import Generate_RTIP_physics as physics
+
+
+#Voxel centre of the first voxel (mm), voxel size (mm) and number of voxels, all (x, y, z)
+CTGeometry = namedtuple('CTGeometry', ['origin', 'spacing', 'shape'])
+
+#dose[z, y, x] in arbitrary units on a grid with the given origin and spacing (mm)
+DoseGrid = namedtuple('DoseGrid', ['dose', 'origin', 'spacing'])
+
+
+def read_ct_geometry(ct_dir):
+    """Grid of the CT series in ct_dir. Only the headers are read (no pixel data)"""
+
+    import dicom as pd
+
+    slices = []
+    for f in sorted(os.listdir(ct_dir)):
+        if not f.lower().endswith('.dcm'):
+            continue
+        data = pd.read_file(os.path.join(ct_dir, f), stop_before_pixels=True)
+        if data.get('Modality') != 'CT':
+            continue
+        slices.append(data)
+    if not slices:
+        raise ValueError("No CT slices in %s" % ct_dir)
+
+    slices.sort(key=lambda s: float(s.ImagePositionPatient[2]))
+    z = np.array([float(s.ImagePositionPatient[2]) for s in slices])
+    first = slices[0]
+    dy, dx = [float(v) for v in first.PixelSpacing]
+    dz = float(np.median(np.diff(z))) if len(z) > 1 else float(first.get('SliceThickness', 1.0))
+    x0, y0 = [float(v) for v in first.ImagePositionPatient[:2]]
+
+    return CTGeometry((x0, y0, float(z[0])), (dx, dy, dz), (int(first.Columns), int(first.Rows), len(slices)))
+
+
+def _beam_axes(gantry_angle):
+    """Unit vectors: beam direction, spot X (in the rotation plane) and spot Y (couch axis)"""
+
+    theta = np.radians(float(gantry_angle))
+    d = np.array([-np.sin(theta), np.cos(theta), 0.0])
+    u = np.array([np.cos(theta), np.sin(theta), 0.0])
+    v = np.array([0.0, 0.0, 1.0])
+
+    return d, u, v
+
+
+def _gaussian_matrix(num, resolution, sigma):
+    """Smoothing of one axis as a matrix. Columns sum to 1 so Gp is conserved"""
+
+    offsets = (np.arange(num)[:,None] - np.arange(num)[None,:])*resolution
+    K = np.exp(-0.5*(offsets/sigma)**2)
+    K[np.abs(offsets) > 4*sigma] = 0
+
+    return K/K.sum(axis=0)
+
+
+def _layer_table(layer_ids, iu, iv, gp, depth_dose, num_u, num_v, resolution, sigma):
+    """Dose table (depth, u, v) of a chunk of layers. layer_ids index rows of depth_dose (layers x depth)"""
+
+    num_layers = depth_dose.shape[0]
+    flat = (layer_ids*num_u + iu)*num_v + iv
+    fluence = np.bincount(flat, weights=gp, minlength=num_layers*num_u*num_v).reshape(num_layers, num_u, num_v)
+
+    Ku = _gaussian_matrix(num_u, resolution, sigma)
+    Kv = _gaussian_matrix(num_v, resolution, sigma)
+    fluence = np.matmul(np.matmul(Ku, fluence), Kv.T)
+
+    return np.dot(depth_dose.T, fluence.reshape(num_layers, num_u*num_v))
+
+
+def dose_grid(geometry, isocenter, gantry_angle, energies, x, y, gp, resolution=2.0, sigma=4.0,
+              chunk_layers=32, chunk_slices=16, workers=None, progress=None, cancel=None):
+    """Approximate dose (arbitrary units) of the spots on a grid of the given resolution (mm) covering
+    the CT. isocenter in mm (patient coordinates), spot x, y in mm at the isocenter, sigma the lateral
+    spot size (mm). workers > 1 builds the layer tables on a process pool. Returns a DoseGrid"""
+
+    energies = np.asarray(energies, dtype=float).ravel()
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    gp = np.asarray(gp, dtype=float).ravel()
+    iso = np.array([float(c) for c in isocenter])
+    d, u, v = _beam_axes(gantry_angle)
+
+    #Output grid over the CT extent
+    origin = np.array(geometry.origin, dtype=float)
+    extent = origin + (np.array(geometry.shape) - 1)*np.array(geometry.spacing)
+    axes = [np.arange(lo, hi + resolution/2, resolution) for lo,hi in zip(origin, extent)]
+
+    #Depth is measured from the first corner of the grid the beam reaches
+    corners = np.array([[cx, cy, cz] for cx in (origin[0], extent[0]) for cy in (origin[1], extent[1])
+                        for cz in (origin[2], extent[2])])
+    t_entry = np.dot(corners - iso, d).min()
+
+    #Fluence plane: spot extent plus the smoothing tail
+    u0 = x.min() - 4*sigma
+    v0 = y.min() - 4*sigma
+    num_u = int(np.ceil((x.max() + 4*sigma - u0)/resolution)) + 1
+    num_v = int(np.ceil((y.max() + 4*sigma - v0)/resolution)) + 1
+    iu = np.clip(((x - u0)/resolution).astype(int), 0, num_u-1)
+    iv = np.clip(((y - v0)/resolution).astype(int), 0, num_v-1)
+
+    #Depth-dose of every distinct energy on bins of one voxel (cm for the range table)
+    unique_E, layer_of_spot = np.unique(energies, return_inverse=True)
+    layer_of_spot = layer_of_spot.ravel()
+    max_range = 10*physics.csda_range(unique_E.max())
+    num_depth = int(np.ceil(max_range/resolution)) + 2
+    depth_dose = physics.depth_dose(unique_E, np.arange(num_depth+1)*resolution/10.0)[:,1:]
+
+    #Sum the layers into one (depth, u, v) table, a chunk of layers at a time
+    chunks = [np.arange(n, min(n+chunk_layers, len(unique_E))) for n in range(0, len(unique_E), chunk_layers)]
+    order = np.argsort(layer_of_spot, kind='stable')
+    bounds = np.searchsorted(layer_of_spot[order], [c[0] for c in chunks] + [len(unique_E)])
+
+    def chunk_args(n):
+        s = order[bounds[n]:bounds[n+1]]
+        return (layer_of_spot[s] - chunks[n][0], iu[s], iv[s], gp[s], depth_dose[chunks[n]],
+                num_u, num_v, resolution, sigma)
+
+    table = np.zeros((num_depth, num_u*num_v))
+    total = len(chunks) + len(axes[2])
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(_layer_table, *chunk_args(n)) for n in range(len(chunks))]
+            for n,job in enumerate(jobs):
+                _check(cancel, jobs)
+                table += job.result()
+                if progress is not None:
+                    progress("Layers %d/%d" % (n+1, len(chunks)), n+1, total)
+    else:
+        for n in range(len(chunks)):
+            _check(cancel)
+            table += _layer_table(*chunk_args(n))
+            if progress is not None:
+                progress("Layers %d/%d" % (n+1, len(chunks)), n+1, total)
+    table = table.ravel()
+
+    #Look up every voxel, a few slices at a time
+    dose = np.zeros((len(axes[2]), len(axes[1]), len(axes[0])), dtype=np.float32)
+    X, Y = np.meshgrid(axes[0] - iso[0], axes[1] - iso[1])
+    for k in range(0, len(axes[2]), chunk_slices):
+        _check(cancel)
+        Z = (axes[2][k:k+chunk_slices] - iso[2])[:,None,None]
+        depth = X*d[0] + Y*d[1] + Z*d[2] - t_entry
+        pu = X*u[0] + Y*u[1] + Z*u[2]
+        pv = X*v[0] + Y*v[1] + Z*v[2]
+
+        k_depth = np.floor(depth/resolution).astype(int)
+        k_u = np.floor((pu - u0)/resolution).astype(int)
+        k_v = np.floor((pv - v0)/resolution).astype(int)
+        inside = (k_depth >= 0) & (k_depth < num_depth) & (k_u >= 0) & (k_u < num_u) & (k_v >= 0) & (k_v < num_v)
+
+        values = np.zeros(inside.shape)
+        values[inside] = table[(k_depth[inside]*num_u + k_u[inside])*num_v + k_v[inside]]
+        dose[k:k+chunk_slices] = values
+        if progress is not None:
+            done = len(chunks) + min(k+chunk_slices, len(axes[2]))
+            progress("Slices %d/%d" % (min(k+chunk_slices, len(axes[2])), len(axes[2])), done, total)
+
+    return DoseGrid(dose, tuple(a[0] for a in axes), (resolution,)*3)
+
+
+def _check(cancel, jobs=()):
+    if cancel is not None and cancel.is_set():
+        for job in jobs:
+            job.cancel()
+        import Generate_RTIP_func3 as gen3
+        raise gen3.Cancelled("Dose calculation cancelled")
+
+
+def spot_map_dose(ct_dir, spots, isocenter, gantry_angle, **kwargs):
+    """dose_grid for an array of spots (columns E, x, y, Gp) over the CT series in ct_dir"""
+
+    geometry = read_ct_geometry(ct_dir)
+    spots = np.asarray(spots)
+
+    return dose_grid(geometry, isocenter, gantry_angle, spots[:,0], spots[:,1], spots[:,2], spots[:,3], **kwargs)
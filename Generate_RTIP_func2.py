@@ -12,8 +12,14 @@ Functions separated into:
 """
 
 import os
-import dicom as pd
 import numpy as np
+from collections import namedtuple
+
+import Generate_RTIP_physics as physics
+
+
+#Summary of a loaded spot map
+SpotMapStats = namedtuple('SpotMapStats', ['name', 'num_spots', 'num_layers', 'total_Gp', 'energies'])
 
 
 def dose_calc(energy):
@@ -27,137 +33,431 @@ def ellipse_vol(a,b,c):
     return 4.18*a*b*c
 
 def dE_dx(E0):
-    dEdx = 205.4*np.power(E0,-0.722) #initial value in MeV/cm
+    dEdx = physics.stopping_power(E0) #initial value in MeV/cm
     return dEdx
 
 
+#Clinical spot map -> RTIP converter run by gen_rtip
+CSV2XML_SCRIPT = 'csv2xml_Clinical_py36.py'
+
+#Spot map csv layout
+NUM_COLS = 9
+BEAM_COL = 0
+ENERGY_COL = 1
+X_COL = 4
+Y_COL = 5
+GP_COL = 6
+
+
+def _is_data_row(line):
+    try:
+        float(line.split(',', 1)[0])
+        return True
+    except ValueError:
+        return False
+
+
+def _parse_rows(lines):
+    """Row by row parse, only used when a file has malformed rows. Returns (data, rows skipped)"""
+
+    rows = []
+    skipped = 0
+    for line in lines:
+        #Blank rows (also as empty cells, e.g. ',,,,' from a spreadsheet) are not errors
+        if not line.strip(', \t\r\n'):
+            continue
+        fields = line.split(',')
+        try:
+            if len(fields) != NUM_COLS:
+                raise ValueError
+            rows.append([float(v) for v in fields])
+        except ValueError:
+            skipped += 1
+
+    return np.array(rows, dtype=float).reshape(len(rows), NUM_COLS), skipped
+
+
+def _parse_lines(lines, header=True):
+    """Parses spot map csv lines into a rows x NUM_COLS float array. Returns (data, rows skipped).
+
+    Header lines before the first data row and blank rows are ignored. Rows without exactly
+    NUM_COLS numeric values (short or long rows, empty cells, text, nan) are dropped and counted"""
+
+    lines = list(lines)
+    start = 0
+    if header:
+        while start < len(lines) and not _is_data_row(lines[start]):
+            start += 1
+    body = lines[start:]
+    if not body:
+        return np.zeros((0, NUM_COLS)), 0
+
+    #Whole file in one call when every row is well formed: loadtxt fails on short rows and
+    #bad values, and the comma count catches rows with extra columns that usecols would hide
+    try:
+        data = np.loadtxt(body, delimiter=',', usecols=range(NUM_COLS), ndmin=2, comments=None)
+    except ValueError:
+        data = None
+    if data is not None and ''.join(body).count(',') == len(data)*(NUM_COLS-1):
+        skipped = 0
+    else:
+        data, skipped = _parse_rows(body)
+
+    complete = ~np.isnan(data).any(axis=1)
+
+    return data[complete], skipped + int(len(data) - complete.sum())
+
+
+class SpotMap(object):
+    """Spot map csv parsed once and shared by validation, dose estimation, plotting and RTIP generation"""
+
+    def __init__(self, data, path=None, skipped=0):
+        self.data = data
+        self.path = path
+        self.name = os.path.basename(path) if path else ''
+        self.skipped = skipped #malformed rows left out of data
+
+    @classmethod
+    def from_csv(cls, file):
+        """Reads the whole spot map in a single pass"""
+        with open(file, 'r') as f:
+            data, skipped = _parse_lines(f)
+        return cls(data, file, skipped)
+
+    @staticmethod
+    def iter_chunks(file, chunk_rows=100000):
+        """Streams the spot map as (array of at most chunk_rows rows, malformed rows skipped) to keep memory bounded"""
+        header = True
+        with open(file, 'r') as f:
+            while True:
+                lines = f.readlines(chunk_rows*64) #~64 bytes per row
+                if not lines:
+                    break
+                data, skipped = _parse_lines(lines, header)
+                header = False
+                for start in range(0, len(data), chunk_rows):
+                    yield data[start:start+chunk_rows], skipped if start == 0 else 0
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def energy(self):
+        return self.data[:,ENERGY_COL]
+
+    @property
+    def x(self):
+        return self.data[:,X_COL]
+
+    @property
+    def y(self):
+        return self.data[:,Y_COL]
+
+    @property
+    def gp(self):
+        return self.data[:,GP_COL]
+
+    def columns(self):
+        """Returns energy, x, y, Gp columns"""
+        return self.data[:,[ENERGY_COL,X_COL,Y_COL,GP_COL]]
+
+
+def _as_spotmap(file):
+    if isinstance(file, SpotMap):
+        return file
+    return SpotMap.from_csv(file)
+
+
 def csv_check(file):
-    
-    #Import data and exclude empty rows
-    data = np.genfromtxt(file, delimiter=',', filling_values=np.nan)
-    data = data[~np.isnan(data).any(axis=1)]
-    rows,cols = data.shape
-    
-    if cols != 9:
+    """Checks the spot map rows have 9 columns. file can be a csv path or a SpotMap"""
+
+    #Count rows chunk by chunk if we only have a path, otherwise use the loaded map
+    if isinstance(file, SpotMap):
+        rows = file.shape[0]
+        skipped = file.skipped
+    else:
+        rows = 0
+        skipped = 0
+        for chunk, chunk_skipped in SpotMap.iter_chunks(file):
+            rows += chunk.shape[0]
+            skipped += chunk_skipped
+
+    if rows == 0:
         csv_msg = 'CSV doesn\'t have 9 columns. Please check'
+    elif skipped:
+        csv_msg = "CSV has %s rows, but %s rows without 9 numeric columns were skipped. Please check" % (rows, skipped)
     else:
         csv_msg = "CSV looks ok! It has %s rows." % rows
    
     return csv_msg   
 
+#Lookup table of already computed curves, keyed by (E0, step)
+_depth_table = {}
+
+def _E_depth_curves(E0, step, n_steps):
+    """Steps every initial energy in E0 through depth at once. Returns energy and dose rows per energy"""
+
+    #One row per energy, one column per depth step (plus two for the stopping point)
+    num = len(E0)
+    E_mat = np.zeros((num, n_steps+3))
+    dose_mat = np.zeros((num, n_steps+3))
+    lengths = np.full(num, n_steps+1)
+    stopped_mask = np.zeros(num, dtype=bool)
+    E_mat[:,0] = E0
+
+    active = np.arange(num)
+    E_current = np.asarray(E0, dtype=float)
+    for i in range(n_steps):
+        if active.size == 0:
+            break
+        dEdx = dE_dx(E_current)
+        E_next = E_current - dEdx*step
+
+        #Protons still moving: store energy and dose deposited in this step
+        moving = E_next > 0
+        E_mat[active[moving], i+1] = E_next[moving]
+        dose_mat[active[moving], i+1] = dEdx[moving]*step
+
+        #Protons stopping: deposit remaining energy, followed by a zero row
+        stopped = active[~moving]
+        dose_mat[stopped, i+1] = E_current[~moving]
+        lengths[stopped] = i+3
+        stopped_mask[stopped] = True
+
+        active = active[moving]
+        E_current = E_next[moving]
+
+    return E_mat, dose_mat, lengths, stopped_mask
+
+def _lookup_curve(e, step, n_steps):
+    """Returns (energy, dose) curve for e from the lookup table, or None if it has to be computed"""
+
+    entry = _depth_table.get((e, step))
+    if entry is None:
+        return None
+    E_curve, dose_curve, stopped = entry
+
+    #Stored curve reaches the stopping point before n_steps runs out
+    if stopped and len(E_curve)-2 <= n_steps:
+        return E_curve, dose_curve
+
+    #Otherwise the first n_steps of the stored curve are valid if it is long enough
+    if len(E_curve)-1 >= n_steps + (1 if stopped else 0):
+        return E_curve[:n_steps+1], dose_curve[:n_steps+1]
+
+    return None
+
+def E_depth_batch(energies, step=0.25, n_steps=500):
+    """Returns depth, energy and dose matrices (layers x depth) for an array of initial energies.
+    Curves are taken from a lookup table so repeated energies are only computed once."""
+
+    energies = np.asarray(energies, dtype=float).ravel()
+    unique_E, inverse = np.unique(energies, return_inverse=True)
+
+    #Compute the energies that aren't in the table yet in a single pass
+    curves = [_lookup_curve(e, step, n_steps) for e in unique_E]
+    missing = [n for n,c in enumerate(curves) if c is None]
+    if missing:
+        E_mat, dose_mat, lengths, stopped = _E_depth_curves(unique_E[missing], step, n_steps)
+        for m,n in enumerate(missing):
+            curves[n] = (E_mat[m,:lengths[m]], dose_mat[m,:lengths[m]])
+            _depth_table[(unique_E[n], step)] = curves[n] + (stopped[m],)
+
+    #Build output matrices, zero padded past the end of each curve
+    lengths = np.array([len(c[0]) for c in curves], dtype=int)
+    num_depths = lengths.max() if len(curves) else 0
+    E_unique = np.zeros((len(curves), num_depths))
+    dose_unique = np.zeros((len(curves), num_depths))
+    for n,(E_curve,dose_curve) in enumerate(curves):
+        E_unique[n,:lengths[n]] = E_curve
+        dose_unique[n,:lengths[n]] = dose_curve
+
+    depth = np.arange(num_depths)*step
+
+    return depth, E_unique[inverse], dose_unique[inverse], lengths[inverse]
+
+def depth_dose_sum(energies, weights, step=0.25, max_depth=None):
+    """Returns depth grid, summed dose and weighted dose per layer (layers x depth) for a plan.
+    Grid spacing is step (cm). Grid length covers the deepest layer unless max_depth (cm) is given.
+    Curves come from the range table (Generate_RTIP_physics), one lookup for all layers.
+    A plan without layers has an empty grid (or zero dose on the max_depth grid)"""
+
+    energies = np.asarray(energies, dtype=float).ravel()
+    weights = np.asarray(weights, dtype=float).ravel()
+    if energies.size == 0 and max_depth is None:
+        return np.zeros(0), np.zeros(0), np.zeros((0, 0))
+
+    #Grid reaches the end of range of the highest energy in the plan, plus two empty bins
+    if max_depth is None:
+        max_range = physics.csda_range(energies.max())
+        n_steps = int(np.ceil(max_range/step)) + 2
+    else:
+        n_steps = int(np.ceil(max_depth/step))
+    depth = np.arange(n_steps+1)*step
+
+    #Each distinct energy is looked up once
+    unique_E, inverse = np.unique(energies, return_inverse=True)
+    dose_vs_depth = physics.depth_dose(unique_E, depth)[inverse.ravel()]
+
+    #Weight each Bragg peak and sum in one reduction
+    layer_dose = dose_vs_depth*weights[:,None]
+    dose_sum = np.dot(weights, dose_vs_depth)
+
+    return depth, dose_sum, layer_dose
+
 #Change to use data frame?
 def E_depth(E0):
     """Returns array of energy of proton and energy deposited vs depth of penetration for a given initial energy, E0"""
-    
-    #Initiate lists starting at depth = 0
-    E_vs_depth = [E0]
-    depth_list = [0]
-    dose_list = [0]
-    step = 0.25 #cm
-    depth = step    
-    
-    #Create energy loss vs depth 
-    for i in range(500):
-        E_next = E_vs_depth[-1] - dE_dx(E_vs_depth[-1])*step
-        
-        # Append lists of proton energy, depth, and dose deposited
-        if E_next > 0:    
-            dose_list.append(dE_dx(E_vs_depth[-1])*step)
-            E_vs_depth.append(E_next)
-            depth_list.append(depth)
-            depth += step
-            
-        # Add final values to end of list and break loop    
-        else:
-            dose_list.extend((E_vs_depth[-1],0))
-            E_vs_depth.extend((0,0))
-            depth_list.extend((depth, depth+step))
-            break
-        
-    #Turn into numpy arrays    
-    depth_list = np.asarray(depth_list)
-    E_vs_depth = np.asarray(E_vs_depth)
-    dose_list = np.asarray(dose_list)
-        
-    energy_vs_depth = np.column_stack((depth_list,E_vs_depth,dose_list))
-                
+
+    depth, E_vs_depth, dose, lengths = E_depth_batch([E0])
+    num = lengths[0]
+
+    energy_vs_depth = np.column_stack((depth[:num],E_vs_depth[0,:num],dose[0,:num]))
+
     return energy_vs_depth
       
-#Need to clean up and make more robust
+def layer_ranges(energies):
+    """CSDA range (cm) of each layer energy"""
+    return physics.csda_range(energies)
+
+def layer_starts(energy):
+    """Returns the index of the first spot of each layer. A layer is a run of spots with the same energy"""
+
+    energy = np.asarray(energy)
+    if energy.size == 0:
+        return np.zeros(0, dtype=int)
+
+    return np.concatenate(([0], np.flatnonzero(energy[1:] != energy[:-1]) + 1))
+
+
+class LayerIndex(object):
+    """Built once per spot map: layer number -> contiguous slice of the spot array, with layer energy and Gp sum"""
+
+    def __init__(self, energy, gp):
+        energy = np.asarray(energy)
+        self.starts = layer_starts(energy)
+        self.stops = np.append(self.starts[1:], len(energy)).astype(int)
+        self.energies = energy[self.starts]
+        if len(self.starts):
+            self.gp = np.add.reduceat(np.asarray(gp, dtype=float), self.starts)
+        else:
+            self.gp = np.zeros(0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def layer(self, n):
+        """Slice of the spot array holding layer n"""
+        return slice(self.starts[n], self.stops[n])
+
+
 def dose_estimator(file):
-    """Estimates the dose deposited from a given treatment spot map"""
-   
-    #Open file and replace empty rows with 'nan' values 
-    data = np.genfromtxt(file, delimiter=',', filling_values=np.nan, usecols=(1,4,5,6))
-    data = data[~np.isnan(data).any(axis=1)] 
-    name = os.path.basename(file)
-
-    #Initiate Values    
-    energy_current = data[0,0]
-    num_spots,foo = data.shape
-    dose_Gp = 0
-    num_layers = 1
-    dose_array = [] #2 column array of proton energy and proton dose
-        
-    #loop through files and calculate cumulative dose
-    for i in range(num_spots):
-        energy = data[i,0]
-            
-       #if we are in new layer
-        if energy != energy_current:
-            num_layers += 1
-            dose_array.append([data[i-1,0],dose_Gp])
-            dose_Gp = data[i,3] 
-            energy_current = energy
-            
-        #if we are at last spot
-        elif i == (num_spots-1): 
-            dose_Gp += data[i,3]
-            dose_array.append([data[i-1,0],dose_Gp])
-            
+    """Estimates the dose deposited from a given treatment spot map (csv path or SpotMap).
+    Returns name, [energy, x, y, Gp] spot data, [energy, Gp] per layer and a SpotMapStats summary"""
+
+    #Energy, x, y and Gp columns of the spot map
+    spots = _as_spotmap(file)
+    data = spots.columns()
+    name = spots.name
+
+    #Group spots into layers and sum Gp per layer
+    starts = layer_starts(data[:,0])
+    if len(starts):
+        layer_Gp = np.add.reduceat(data[:,3], starts)
+    else:
+        layer_Gp = np.zeros(0)
+    dose_array = np.column_stack((data[starts,0], layer_Gp)) #2 column array of proton energy and proton dose
+
+    #Organize total protons, energies
+    stats = SpotMapStats(name=name,
+                         num_spots=data.shape[0],
+                         num_layers=len(starts),
+                         total_Gp=np.sum(layer_Gp),
+                         energies=np.unique(dose_array[:,0]))
+
+    return name, data, dose_array, stats
+
+
+def format_stats(stats):
+    """Text summary of a SpotMapStats for display"""
+
+    str1 = 'Num Spots = ' + str(stats.num_spots)
+    str2 = 'Num Layers = ' + str(stats.num_layers)
+    str3 = 'Total Gp = ' + str(stats.total_Gp)
+    str4 = "Unique energies = " + str(stats.energies)
+    if len(stats.energies):
+        ranges = layer_ranges(stats.energies)
+        str5 = "CSDA range = %.1f - %.1f cm" % (ranges.min(), ranges.max())
+    else:
+        str5 = "CSDA range = -"
+
+    return '\n'.join((str1, str2, str3, str4, str5))
+
+
+def _set_setup_beam(ibs):
+    """Make beam 0 the setup beam"""
+    ibs[0].TreatmentDeliveryType = 'SETUP'
+    ibs[0].IonControlPointSequence[0].PatientSupportAngle = '90'
+
+
+def csv2xml_plan_sequences(file, setup=False, script=CSV2XML_SCRIPT):
+    """Runs the clinical csv2xml converter on a spot map (csv path or SpotMap) and returns the Fraction
+    Group Sequence and Ion Beam Sequence of the RTIP it writes. The converter runs in a scratch
+    directory, so nothing in the working directory is touched and parallel runs don't collide"""
+
+    import sys
+    import shutil
+    import tempfile
+    import subprocess
+    import dicom as pd
+
+    script = os.path.abspath(script)
+    if not os.path.isfile(script):
+        raise IOError("Spot map converter %s not found" % script)
+
+    work_dir = tempfile.mkdtemp(prefix='csv2xml_')
+    try:
+        #The converter writes its xml/dcm files next to its input or into its working directory
+        if isinstance(file, SpotMap) and not file.path:
+            csv_name = 'spotmap.csv'
+            np.savetxt(os.path.join(work_dir, csv_name), file.data, fmt='%.10g', delimiter=',')
         else:
-            dose_Gp += data[i,3]
-   
-    #Organize dose array, total protons, energies
-    dose_array = np.asarray(dose_array)
-    tot_p = np.sum(dose_array[:,1])
-    energies = np.unique(dose_array[:,0])
+            path = file.path if isinstance(file, SpotMap) else file
+            csv_name = os.path.basename(path)
+            shutil.copy(path, os.path.join(work_dir, csv_name))
+
+        try:
+            subprocess.run([sys.executable, script, csv_name], cwd=work_dir, check=True)
+        except subprocess.CalledProcessError as e:
+            raise IOError("Spot map converter failed. %s" % e)
 
-    #Make strings for output
-    str1 = 'Num Spots = ' + str(num_spots)
-    str2 = 'Num Layers = ' + str(num_layers)
-    str3 = 'Total Gp = ' + str(tot_p)
-    str4 = "Unique energies = " + str(energies)
-    
-    #save ALL THE DATA!!
-    f = open(name+'.txt', 'wb') 
-    np.savetxt(f,(str1, str2, str3, str4), fmt='%s', delimiter=' ')
-    f.close()
+        rtip = [f for f in os.listdir(work_dir) if 'RTIP.dcm' in f]
+        if not rtip:
+            raise IOError("Spot map converter didn't write an RTIP")
+        data = pd.read_file(os.path.join(work_dir, rtip[0]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-    return name, data, dose_array        
+    fgs = data.FractionGroupSequence
+    ibs = data.IonBeamSequence
+    if setup:
+        _set_setup_beam(ibs)
+
+    return fgs, ibs
+
+
+def plan_sequences(file, setup=False):
+    """Fraction Group Sequence and Ion Beam Sequence for a spot map (csv path or SpotMap), from the
+    clinical csv2xml converter"""
+
+    return csv2xml_plan_sequences(file, setup)
 
 
 def gen_rtip(csv_filename, phantom_dir,setup=False):
-    
-    #Make clincial dicom set of spot map
-    os.system("python csv2xml_Clinical_py36.py " + csv_filename)
-    
-    #Find the generated rtip 
-    rtip = [f for f in os.listdir() if 'RTIP.dcm' in f][0]
+    """Makes the Fraction Group Sequence and Ion Beam Sequence of a new plan from a spot map (csv path or SpotMap)"""
+
     ct_dir = phantom_dir + '/'
+    fgs, ibs = plan_sequences(csv_filename, setup)
 
-    #Extract Fraction Group Sequence and Ion Beam Sequence
-    data_copyinfo = pd.read_file(rtip)
-    fgs = data_copyinfo.FractionGroupSequence
-    ibs = data_copyinfo.IonBeamSequence
-    
-    #Make beam 0 the setup beam
-    if setup:
-        ibs[0].TreatmentDeliveryType = 'SETUP'
-        ibs[0].IonControlPointSequence[0].PatientSupportAngle = '90'
-                
-    #Delete extra dicom/xml files from the working directory
-    [os.remove(f) for f in os.listdir() if '.dcm' in f.lower()]
-    [os.remove(f) for f in os.listdir() if '.xml' in f.lower()]
-    
     return ct_dir, fgs, ibs
@@ -11,25 +11,163 @@ Functions separated into:
 @author: mpetterson
 """
 
+import io
 import os
+import json
 import random
+import hashlib
+import threading
 import dicom as pd
+from dicom.UID import generate_uid
+from concurrent.futures import ThreadPoolExecutor
 
-from ftplib import FTP
-import paramiko
+import Generate_RTIP_func2 as gen2
+import Generate_RTIP_trace as trace
+from Dicom_upload import upload, format_results, session_files
+
+
+#Fingerprints of the inputs of each stage, kept in the session directory
+SESSION_STATE = '.session_state.json'
+STATE_VERSION = 2
+
+#Most a SessionWorkspace holds in memory, the rest of the series goes straight to disk
+MAX_WORKSPACE_BYTES = 256*1024**2
+
+
+class Cancelled(Exception):
+    """Raised when a long running step is cancelled by the user"""
+    pass
 
   
-def gen_dicom(fname,lname,ct_dir):
-    """Generates a session by cloning phantom selected in GUI"""
-    
-    #Assign name, ID, and make directory for new session
+class UidMap(object):
+    """Phantom UID -> new UID for one session. Shared by every file cloned into the session, so each
+    instance gets its own SOP Instance UID, the series share new Study/Series/Frame of Reference UIDs
+    and references between the files (RTIP -> structure set -> CT) still point at each other"""
+
+    def __init__(self, mapping=None):
+        self.mapping = dict(mapping or {})
+        self._lock = threading.Lock()
+
+    def __call__(self, uid):
+        with self._lock:
+            if uid not in self.mapping:
+                self.mapping[uid] = generate_uid()
+            return self.mapping[uid]
+
+
+def _is_instance_uid(keyword):
+    #SOP/Study/Series instance UIDs, frame of reference UIDs and references to them. Class and
+    #transfer syntax UIDs are left alone
+    return keyword.endswith('InstanceUID') or keyword.endswith('FrameOfReferenceUID')
+
+
+def _remap_uids(data, uids):
+    """Replaces the instance and frame of reference UIDs of a dataset (and its sequences) through uids.
+    Only the UID elements and sequences are read, deferred values like pixel data stay on disk"""
+
+    for keyword in data.dir():
+        if keyword.endswith('Sequence'):
+            for item in getattr(data, keyword) or []:
+                _remap_uids(item, uids)
+        elif _is_instance_uid(keyword):
+            value = getattr(data, keyword)
+            if isinstance(value, str):
+                setattr(data, keyword, uids(value))
+            else:
+                setattr(data, keyword, [uids(v) for v in value])
+
+
+def _write_file(path, payload):
+    with open(path, 'wb') as f:
+        f.write(payload)
+
+
+def _clone_file(src, name, attrs, uids, sink):
+    """Copies one dicom file, rewriting only the tags in attrs and (with a UidMap) the UIDs, and hands
+    the encoded copy to sink(name, payload). Pixel data is deferred and written back undecoded.
+    Returns the size of the copy"""
+
+    payload = _clone_bytes(src, attrs, uids)
+    sink(name, payload)
+
+    return len(payload)
+
+
+def _clone_bytes(src, attrs, uids=None):
+    """The encoded copy of one dicom file with the tags in attrs (and UIDs) rewritten, without touching the disk"""
+
+    data = pd.read_file(src, defer_size=1024)
+    for tag,value in attrs.items():
+        setattr(data, tag, value)
+    if uids is not None:
+        _remap_uids(data, uids)
+        if getattr(data, 'file_meta', None) is not None:
+            _remap_uids(data.file_meta, uids)
+
+    return _encode(data)
+
+
+def _encode(data):
+    buf = io.BytesIO()
+    pd.write_file(buf, data)
+    return buf.getvalue()
+
+
+def _is_rtip(f):
+    return 'RTIP' in f and '.dcm' in f.lower()
+
+
+def _series_files(ct_dir):
+    return [f for f in sorted(os.listdir(ct_dir)) if os.path.isfile(os.path.join(ct_dir,f))]
+
+
+def clone_series(ct_dir, new_dir, attrs, workers=8, progress=None, cancel=None, uids=None, sink=None):
+    """Clones every dicom file in ct_dir into new_dir using a thread pool, with new patient tags and new
+    UIDs (a fresh UidMap unless one is given). Errors are raised, not swallowed.
+    sink(name, payload) receives each encoded copy from the worker threads instead of it being written
+    to new_dir (SessionWorkspace keeps them in memory).
+    progress(message, done, total) is called per file, setting the cancel event stops the remaining files"""
+
+    files = _series_files(ct_dir)
+    if uids is None:
+        uids = UidMap()
+    if sink is None:
+        sink = lambda name, payload: _write_file(os.path.join(new_dir, name), payload)
+
+    with trace.span('clone_series', source=ct_dir, workers=workers) as s, ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(_clone_file, os.path.join(ct_dir,f), f, attrs, uids, sink) for f in files]
+        for n,job in enumerate(jobs):
+            if cancel is not None and cancel.is_set():
+                for j in jobs:
+                    j.cancel()
+                raise Cancelled("Cloning cancelled")
+            s.add(bytes=job.result(), files=1)
+            if progress is not None:
+                progress("Cloned %s" % files[n], n+1, len(files))
+
+    return files
+
+
+def _session_attrs(fname,lname):
+    """Directory name and patient tags of a new session"""
+
     p_name = lname + '^' + fname
     p_id = fname + '_' + ''.join(random.choice('1234567890ABCDEF') for i in range(3))
     new_dir = fname+'_'+lname
+    attrs = {'PatientName': p_name, 'PatientID': p_id, 'PatientBirthDate': '19830104', 'PatientSex': 'F'}
+
+    return new_dir, attrs
+
+
+def gen_dicom(fname,lname,ct_dir,workers=8,progress=None,cancel=None):
+    """Generates a session by cloning phantom selected in GUI"""
+    
+    #Assign name, ID, and make directory for new session
+    new_dir, attrs = _session_attrs(fname, lname)
     os.mkdir(new_dir)
     
     #Do the work
-    os.system("python cpydcm2_36_mkp.py -i "+ct_dir+" -o ./"+new_dir+" -cconv -attr \"PatientName : "+p_name+", PatientID : "+ p_id+", PatientBirthDate : 19830104, PatientSex : F\"")
+    clone_series(ct_dir, new_dir, attrs, workers, progress, cancel)
     done_msg = "Data saved to directory: %s " % new_dir
     new_dir = new_dir + '/'
         
@@ -37,32 +175,56 @@ def gen_dicom(fname,lname,ct_dir):
     
     
 def replace_iso_gantry_spots(pdir,x=None,y=None,z=None,angle=None,fgs=None,ibs=None):
-    
-    rtip = [f for f in os.listdir(pdir) if 'RTIP' in f and '.dcm' in f.lower()][0]
-    data = pd.read_file(pdir+rtip)
-    
-    num_beams = len(data.IonBeamSequence)
-    
-    if x and y and z:
-        for i in range(num_beams):
-            data.IonBeamSequence[i].IonControlPointSequence[0].IsocenterPosition[0] = str(x)
-            data.IonBeamSequence[i].IonControlPointSequence[0].IsocenterPosition[1] = str(y)
-            data.IonBeamSequence[i].IonControlPointSequence[0].IsocenterPosition[2] = str(z)
-    else:
-        pass
-    
-    if angle:
-        for i in range(num_beams):
-            data.IonBeamSequence[i].IonControlPointSequence[0].GantryAngle = str(angle)
-    else:
-        pass
-    
-    #Copy fraction group sequence and ion beam sequence if we are making a new plan
+    """Patches isocenter, gantry angle, plan labels and setup beam of the session RTIP.
+    Large values (spot maps, weights) stay deferred and the file is replaced atomically"""
+
+    with trace.span('patch_rtip', session=pdir, new_plan=bool(fgs and ibs)) as s:
+        rtip_path = _patch_rtip(pdir, x, y, z, angle, fgs, ibs)
+        s.add(bytes=os.path.getsize(rtip_path), files=1)
+
+
+def _patch_rtip(pdir, x, y, z, angle, fgs, ibs):
+    rtip = [f for f in os.listdir(pdir) if _is_rtip(f)][0]
+    rtip_path = os.path.join(pdir, rtip)
+    data = pd.read_file(rtip_path, defer_size=1024)
+    _apply_plan(data, x, y, z, angle, fgs, ibs)
+
+    #Write to a temporary file next to the original (deferred values are read from it), then swap
+    tmp_path = rtip_path + '.tmp'
+    try:
+        pd.write_file(tmp_path, data)
+        os.replace(tmp_path, rtip_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return rtip_path
+
+
+def _apply_plan(data, x, y, z, angle, fgs, ibs):
+    """Sets the new plan (if any), geometry, labels and setup beam on an RTIP dataset in place"""
+
+    #Copy fraction group sequence and ion beam sequence if we are making a new plan,
+    #keeping the isocenter and gantry angle of the old plan unless new ones are given.
+    #None means not given: 0 is a valid angle or coordinate
+    new_isocenter = x is not None and y is not None and z is not None
     if fgs and ibs:
+        old_cp = data.IonBeamSequence[0].IonControlPointSequence[0]
         data.FractionGroupSequence = fgs
         data.IonBeamSequence = ibs
-    else:
-        pass
+        if not new_isocenter:
+            x, y, z = old_cp.IsocenterPosition
+            new_isocenter = True
+        if angle is None and 'GantryAngle' in old_cp:
+            angle = old_cp.GantryAngle
+
+    #Only the first control point of each beam holds the geometry
+    for beam in data.IonBeamSequence:
+        cp = beam.IonControlPointSequence[0]
+        if new_isocenter:
+            cp.IsocenterPosition = [str(x), str(y), str(z)]
+        if angle is not None:
+            cp.GantryAngle = str(angle)
     
     #Make sure other items are dicom-compliant (labels/names/geometry/)
     data.RTPlanLabel = 'label'
@@ -71,90 +233,232 @@ def replace_iso_gantry_spots(pdir,x=None,y=None,z=None,angle=None,fgs=None,ibs=N
     data.FractionGroupSequence[0].FractionGroupNumber = '1'
     
     #Check the setup beam
-    if data.IonBeamSequence[0].IonControlPointSequence[0].NominalBeamEnergy == '0':
+    if float(data.IonBeamSequence[0].IonControlPointSequence[0].NominalBeamEnergy) == 0:
         data.IonBeamSequence[0].TreatmentDeliveryType = 'SETUP'
         data.IonBeamSequence[0].IonControlPointSequence[0].PatientSupportAngle = '90'
-    
-    #Write data to file
-    pd.write_file(pdir+rtip[0],data)
-    
-    
-def upload(pdir):
-    """Uploads dicom session (CT set/RTIP/RTSS/PSSR/RTBDI)"""
-    
-    #Get folder to copy over
-    directory_name = pdir
-    files = [f for f in os.listdir(path=directory_name)]
-    
-    #Get environment
-    f = open('credentials.txt', 'r')
-    credentials = f.readlines()
-    pacs = credentials[0].replace('\n','').split(' ')
-    wb = credentials[1].split(' ')
-    pacs_info = {"address": pacs[0], "username": pacs[1], "password": pacs[2]}
-    wb_info = {"address": wb[0], "username": wb[1], "password": wb[2], "port": wb[3]}   
-        
 
-    #Connect to host/PACS computer
-    try:
-        ssh_client_pacs = paramiko.SSHClient()
-        ssh_client_pacs.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client_pacs.connect(hostname=pacs_info['address'], username=pacs_info['username'], password=pacs_info['password'])
-        print("Connected to PACS host")
-        
-    except:
-        msg = "Could not connect to network."
-        return msg
-        
-    #Upload data to host
-    try:
-        stdin,stdout,stderr = ssh_client_pacs.exec_command('cd sessions; mkdir %s; ls' % directory_name)
-        print("Directory created. Starting upload")
-    
-        #Uploading directory - using recursive file upload
-        for f in files:
-            ftp_client = ssh_client_pacs.open_sftp()
-            ftp_client.put(os.path.join(directory_name,f),'sessions/'+directory_name+f)
-            ftp_client.close()
-    
-    except:
-        msg = "Could not upload files"
-        return msg
-        
-    #Transmit to PACS
-    print("Transmitting to PACS")
-    try:
-        stdin,stdout,stderr = ssh_client_pacs.exec_command('./upload_session_data_to_pacs.sh ~/sessions/'+directory_name)
-        print(stdout.readlines())
-        print(directory_name)
-        ssh_client_pacs.close()
-    except:
-        msg = "Could not transmist files to PACS"
-        return msg
+
+class SessionWorkspace(object):
+    """A session held in memory between stages: the cloned series as encoded bytes and the patched RTIP.
+    write() puts each file on disk exactly once and upload() streams the same bytes to PACS and WB,
+    so nothing is read back from the session directory. At most max_bytes of the series are held,
+    files past that are written to the session directory (which must exist) while cloning and are
+    read from there on upload. The RTIP is always held. release() frees the buffers"""
+
+    def __init__(self, new_dir, uids=None, max_bytes=MAX_WORKSPACE_BYTES):
+        self.new_dir = new_dir
+        self.files = {}
+        self.series = []
+        self.rtip_name = None
+        self.done_msg = None
+        self.uids = uids if uids is not None else UidMap()
+        self.max_bytes = max_bytes
+        self.held = 0
+        self._lock = threading.Lock()
+
+    def clone(self, ct_dir, attrs, workers=8, progress=None, cancel=None):
+        """Encodes a copy of every file of the phantom with the new patient tags and the session's UIDs"""
+
+        self.series = _series_files(ct_dir)
+        rtips = [f for f in self.series if _is_rtip(f)]
+        self.rtip_name = rtips[0] if rtips else None
+
+        clone_series(ct_dir, self.new_dir, attrs, workers, progress, cancel, self.uids, sink=self._keep)
+
+    def _keep(self, name, payload):
+        #clone_series sink: hold the file while there is room, spill it to the session directory otherwise
+        with self._lock:
+            hold = _is_rtip(name) or self.held + len(payload) <= self.max_bytes
+            if hold:
+                self.held += len(payload)
+        if hold:
+            self.files[name] = payload
+        else:
+            _write_file(os.path.join(self.new_dir, name), payload)
+
+    def patch_rtip(self, x=None, y=None, z=None, angle=None, fgs=None, ibs=None):
+        """replace_iso_gantry_spots on the in-memory RTIP"""
+
+        with trace.span('patch_rtip', session=self.new_dir, new_plan=bool(fgs and ibs)) as s:
+            data = pd.read_file(io.BytesIO(self.files[self.rtip_name]))
+            _apply_plan(data, x, y, z, angle, fgs, ibs)
+            self.files[self.rtip_name] = _encode(data)
+            s.add(bytes=len(self.files[self.rtip_name]), files=1)
+
+    def write(self):
+        """Writes every held file to the session directory (which must exist)"""
+
+        with trace.span('write_session', session=self.new_dir) as s:
+            for f in sorted(self.files):
+                with open(os.path.join(self.new_dir, f), 'wb') as out:
+                    out.write(self.files[f])
+                s.add(bytes=len(self.files[f]), files=1)
+
+    def read(self, f):
+        """Encoded bytes of a session file, or None if it isn't held in memory"""
+        return self.files.get(f)
+
+    def upload(self, workers=4, resume=True, progress=None, cancel=None):
+        """Uploads the session from memory (see Dicom_upload.upload)"""
+
+        import Dicom_upload
+        return Dicom_upload.upload(self.new_dir, workers, resume, progress=progress, cancel=cancel, read=self.read)
+
+    def release(self):
+        self.files = {}
+        self.held = 0
     
-    #FTP into second VM
-    try:    
-        print('FTP into WB computer')
-        ftp_client = FTP()
-        ftp_client.connect(wb_info['address'], wb_info['port'])
-        ftp_client.login(wb_info['username'], wb_info['password'])
-        #ftp_client.retrlines('LIST')
-    except:
-        msg = "Could not connect to WB computer"
-        return msg
     
-    #Copy dicom files over one at a time (only works for dicom. Use storlines for text files)
+def generate_session(phantom_dir,fname,lname,csv_file=None,setup=False,x=None,y=None,z=None,angle=None,plan=None,
+                     progress=None,cancel=None):
+    """Runs the whole generation for one session: new plan from csv (optional), clone phantom, patch RTIP.
+    plan can be a prebuilt (fgs, ibs) pair to skip parsing the csv again"""
+
+    workspace = build_session(phantom_dir, fname, lname, csv_file, setup, x, y, z, angle, plan, progress, cancel)
+    workspace.release()
+
+    return workspace.new_dir, workspace.done_msg
+
+
+def _fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+def _csv_fingerprint(csv_file, setup):
+    """Hash of the spot map contents (path or SpotMap) and the setup flag"""
+
+    if isinstance(csv_file, gen2.SpotMap) and not csv_file.path:
+        digest = hashlib.sha1(csv_file.data.tobytes()).hexdigest()
+    else:
+        import Generate_RTIP_cache as cache
+        digest = cache.file_hash(csv_file.path if isinstance(csv_file, gen2.SpotMap) else csv_file)
+
+    return _fingerprint(digest, bool(setup))
+
+
+def _plan_fingerprint(plan):
+    """Hash of every value in a prebuilt (fgs, ibs) pair"""
+
+    h = hashlib.sha1()
+
+    def walk(data):
+        for elem in data:
+            if elem.VR == 'SQ':
+                h.update(str(elem.tag).encode())
+                for item in elem.value:
+                    walk(item)
+            else:
+                h.update(('%s=%r' % (elem.tag, elem.value)).encode())
+
+    for sequence in plan:
+        for item in sequence:
+            walk(item)
+
+    return _fingerprint('plan', h.hexdigest())
+
+
+def read_session_state(new_dir):
+    """Stage fingerprints of an existing session, or None"""
+
     try:
-        ftp_client.mkd(directory_name)
-        print("Copying dicom files to WB server")
-        for f in files:
-            with open(os.path.join(directory_name,f),'rb') as dcm_file:
-                ftp_client.storbinary('STOR %s' % os.path.join(directory_name,f), dcm_file)
-        ftp_client.quit()
-        print("Finished copying files to remote server")
-    except:
-        msg = "Could not transmit files to WB computer"
-        return msg
-    
-    msg = "Everything worked, surprisingly"
-    return msg
\ No newline at end of file
+        with open(os.path.join(new_dir, SESSION_STATE), 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def _write_session_state(new_dir, state):
+    path = os.path.join(new_dir, SESSION_STATE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def build_session(phantom_dir,fname,lname,csv_file=None,setup=False,x=None,y=None,z=None,angle=None,plan=None,
+                  progress=None,cancel=None,session=None):
+    """generate_session, keeping the session in memory afterwards. Returns the SessionWorkspace,
+    already written to disk, whose upload() doesn't re-read the files. The session directory is
+    first_last unless a session name is given.
+
+    Regenerating an existing session only redoes the stages whose inputs changed, going by the
+    fingerprints saved in the session directory: the series is only cloned again for a different
+    phantom (or phantom contents), the plan is only rebuilt for a different csv/setup (or prebuilt
+    plan, or none), a new isocenter or gantry angle only re-patches and rewrites the RTIP, and
+    identical inputs leave the session untouched"""
+
+    import Generate_RTIP_index as index
+
+    new_dir, attrs = _session_attrs(fname, lname)
+    new_dir = session or new_dir
+
+    with trace.span('generate_session', phantom=phantom_dir, session=new_dir):
+        geometry = [None if v is None else str(v) for v in (x, y, z, angle)]
+        clone_fp = _fingerprint(os.path.abspath(phantom_dir), index.dir_signature(phantom_dir), fname, lname)
+        if plan is not None:
+            plan_fp = _plan_fingerprint(plan)
+        elif csv_file:
+            plan_fp = _csv_fingerprint(csv_file, setup)
+        else:
+            plan_fp = _fingerprint('phantom plan')
+
+        state = read_session_state(new_dir) if os.path.isdir(new_dir) else None
+        reuse_clone = state is not None and state['clone'] == clone_fp
+        reuse_plan = reuse_clone and state['plan'] == plan_fp
+
+        if reuse_plan and state['geometry'] == geometry:
+            workspace = SessionWorkspace(new_dir + '/')
+            workspace.done_msg = "Session %s is up to date" % new_dir
+            return workspace
+
+        #Generate new RTIP from csv, otherwise keep the phantom plan
+        fgs = None
+        ibs = None
+        if plan is not None:
+            fgs, ibs = plan
+        elif reuse_plan and csv_file:
+            #The session RTIP already carries this plan
+            session_rtip = pd.read_file(os.path.join(new_dir, state['rtip']))
+            fgs, ibs = session_rtip.FractionGroupSequence, session_rtip.IonBeamSequence
+        elif csv_file:
+            if progress is not None:
+                progress("Building plan from csv", 0, 0)
+            with trace.span('build_plan', setup=setup):
+                ct_dir, fgs, ibs = gen2.gen_rtip(csv_file, phantom_dir, setup)
+
+        if reuse_clone:
+            #Same phantom and patient: keep the series (patient ID and UIDs), start again from the phantom RTIP
+            attrs = state['attrs']
+            workspace = SessionWorkspace(new_dir + '/', UidMap(state['uids']))
+            workspace.rtip_name = state['rtip']
+            workspace._keep(workspace.rtip_name, _clone_bytes(os.path.join(phantom_dir, workspace.rtip_name), attrs,
+                                                              workspace.uids))
+            done_msg = "RTIP updated in directory: %s " % new_dir
+        else:
+            #Make the directory first so a name clash with a file fails before any work is done
+            if not os.path.isdir(new_dir):
+                os.mkdir(new_dir)
+            workspace = SessionWorkspace(new_dir + '/')
+            workspace.clone(phantom_dir, attrs, progress=progress, cancel=cancel)
+            done_msg = "Data saved to directory: %s " % new_dir
+
+            #Drop files left over from a different phantom
+            for f in session_files(new_dir):
+                if f not in workspace.series:
+                    os.remove(os.path.join(new_dir, f))
+
+        if progress is not None:
+            progress("Patching RTIP", 0, 0)
+        workspace.patch_rtip(x, y, z, angle, fgs, ibs)
+
+        if progress is not None:
+            progress("Writing session", 0, 0)
+        workspace.write()
+        workspace.done_msg = done_msg
+
+        _write_session_state(new_dir, {'version': STATE_VERSION, 'clone': clone_fp, 'plan': plan_fp,
+                                       'geometry': geometry, 'attrs': attrs, 'rtip': workspace.rtip_name,
+                                       'uids': workspace.uids.mapping})
+
+    return workspace
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the phantom directory for the GUI dropdown.
+
+Stores the phantom list and, per phantom, the isocenter, gantry angle, spot map and specs
+text so selecting a phantom doesn't re-read its RTIP. Entries are keyed by a signature of
+the directory listing (names, sizes and mtimes), so adding, removing or editing a file
+invalidates only that phantom. Only a stat per file is needed to check a signature.
+
+The index lives in the per-user cache directory (one subdirectory per phantom share), not in
+the shared phantom directory. The small fields are plain JSON, read when the window opens;
+each phantom's spot map is a .npy file next to it, only loaded when that phantom is selected.
+Nothing in either is executed on load and anything that can't be read or doesn't look right
+is a cache miss.
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'TreatmentPlanGUI', 'phantoms')
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 3
+
+
+def dir_signature(path):
+    """Hash of the names, sizes and mtimes of everything in path (hidden files, like the index, are skipped)"""
+
+    sig = hashlib.sha1()
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name.startswith('.'):
+            continue
+        st = entry.stat()
+        sig.update(('%s %d %d\n' % (entry.name, st.st_size, st.st_mtime_ns)).encode())
+
+    return sig.hexdigest()
+
+
+def _index_dir(phantom_path, index_root=INDEX_DIR):
+    """Cache directory of one phantom share"""
+    return os.path.join(index_root, hashlib.sha1(os.path.abspath(phantom_path).encode()).hexdigest()[:16])
+
+
+def _spot_map_name(name):
+    return 'spotmap_' + hashlib.sha1(name.encode()).hexdigest()[:16] + '.npy'
+
+
+class PhantomIndex(object):
+    """Cached phantom list and per-phantom info, saved in the per-user cache directory"""
+
+    def __init__(self, phantom_path, index_dir=None):
+        self.phantom_path = phantom_path
+        self.index_dir = index_dir or _index_dir(phantom_path)
+        self.index_file = os.path.join(self.index_dir, INDEX_NAME)
+        self.index = {'version': INDEX_VERSION, 'phantoms': None, 'entries': {}}
+
+        #A missing, stale, partly written or foreign index just means everything is re-read
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            if _valid(index):
+                self.index = index
+        except Exception:
+            pass
+
+    def phantom_list(self):
+        """Phantom names, only re-scanned when the phantom directory changes"""
+
+        sig = dir_signature(self.phantom_path)
+        cached = self.index.get('phantoms')
+        if cached is None or cached[0] != sig:
+            import Generate_RTIP_func1 as gen1
+            self.index['phantoms'] = (sig, list(gen1.get_phantom_list(self.phantom_path)))
+            self.save()
+
+        return self.index['phantoms'][1]
+
+    def get(self, name):
+        """Returns dict with isocenter, gantry_angle, msg, specs (text) and spot_map for a phantom"""
+
+        phantom_dir = os.path.join(self.phantom_path, name) + '/'
+        sig = dir_signature(phantom_dir)
+        cached = self.index['entries'].get(name)
+        if isinstance(cached, list) and len(cached) == 2 and cached[0] == sig:
+            try:
+                return self._load_entry(cached[1])
+            except Exception:
+                pass
+
+        #Read the RTIP once and keep everything the GUI needs. The dicom stack is only loaded on a cache miss
+        import numpy as np
+        import Generate_RTIP_func1 as gen1
+        isocenter, gantry_angle, msg = gen1.get_isocenter(phantom_dir)
+        specs, spot_map = gen1.plot_rtip_map(phantom_dir)
+        with open(specs, 'r') as f:
+            specs_text = f.read()
+
+        info = {'isocenter': [str(v) for v in isocenter], 'gantry_angle': str(gantry_angle), 'msg': str(msg),
+                'specs': specs_text, 'spot_map': np.asarray(spot_map, dtype=float)}
+
+        #Spot map first, so the index never points at a missing file. Signature taken after reading
+        #in case the specs file was written into the phantom directory
+        spot_map_file = _spot_map_name(name)
+        if self._write(spot_map_file, lambda f: np.save(f, info['spot_map'])):
+            entry = dict(info, spot_map=spot_map_file)
+            self.index['entries'][name] = [dir_signature(phantom_dir), entry]
+            self.save()
+
+        return info
+
+    def _load_entry(self, entry):
+        import numpy as np
+        spot_map = np.load(os.path.join(self.index_dir, entry['spot_map']), allow_pickle=False)
+        if spot_map.ndim != 2:
+            raise ValueError("Bad spot map in index")
+        return dict(entry, spot_map=spot_map.astype(float))
+
+    def save(self):
+        self._write(INDEX_NAME, lambda f: f.write(json.dumps(self.index).encode()))
+
+    def _write(self, name, write):
+        """Writes a file of the index through a unique temporary name, then swaps it in. Returns
+        False if the cache directory isn't writable (the index then just lives for this session)"""
+
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=self.index_dir)
+        except (IOError, OSError):
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, os.path.join(self.index_dir, name))
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _valid(index):
+    """Layout check of a loaded index: {version, phantoms: None or [signature, names], entries: {name: [signature, info]}}"""
+
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION or not isinstance(index.get('entries'), dict):
+        return False
+    phantoms = index.get('phantoms')
+    return phantoms is None or (isinstance(phantoms, list) and len(phantoms) == 2 and isinstance(phantoms[1], list))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs for the GUI. Session generation and uploads run on a QThreadPool so the
+window stays responsive; each job reports back through Qt signals:
+
+    progress(job, message, done, total)
+    throughput(job, destination, file, MB/s)
+    finished(job, result)
+    failed(job, message)
+
+Finished trace spans (see Generate_RTIP_trace) are passed to the GUI thread through TraceSignals.
+
+"""
+
+import functools
+import itertools
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(str, str, int, int)
+    throughput = pyqtSignal(str, str, str, float)
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+
+class TraceSignals(QObject):
+    span = pyqtSignal(object)
+
+
+_job_ids = itertools.count(1)
+
+
+class Job(QRunnable):
+    """Runs func(*args, progress=..., cancel=..., **kwargs) on the thread pool. name is for display,
+    id tells apart jobs with the same name (e.g. the same session uploaded twice)"""
+
+    def __init__(self, name, func, *args, **kwargs):
+        super().__init__()
+        self.id = next(_job_ids)
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+        self.signals = JobSignals()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        import Generate_RTIP_func3 as gen3
+        try:
+            result = self.func(*self.args, cancel=self.cancel_event, **self.kwargs)
+        except gen3.Cancelled:
+            self.signals.failed.emit(self.name, "Cancelled")
+        except Exception as e:
+            self.signals.failed.emit(self.name, "%s: %s" % (type(e).__name__, e))
+        else:
+            self.signals.finished.emit(self.name, result)
+
+
+class GenerateJob(Job):
+    """Generates one session. The result is its SessionWorkspace (see gen3.build_session)"""
+
+    def __init__(self, name, *args, **kwargs):
+        import Generate_RTIP_func3 as gen3
+        super().__init__(name, gen3.build_session, *args, progress=self._progress, **kwargs)
+
+    def _progress(self, message, done, total):
+        self.signals.progress.emit(self.name, message, done, total)
+
+
+class Dose3DJob(Job):
+    """Approximate 3D dose of a spot map over a phantom CT (see Generate_RTIP_dose3d.spot_map_dose)"""
+
+    def __init__(self, name, *args, **kwargs):
+        import Generate_RTIP_dose3d as dose3d
+        super().__init__(name, dose3d.spot_map_dose, *args, progress=self._progress, **kwargs)
+
+    def _progress(self, message, done, total):
+        self.signals.progress.emit(self.name, message, done, total)
+
+
+class UploadJob(Job):
+    """Uploads one session directory to PACS and WB (see Dicom_upload.upload), from memory if its
+    SessionWorkspace is given. The workspace is released once both destinations succeed (released
+    is then True). Progress counts the sends still to do, not the files in the session"""
+
+    def __init__(self, name, pdir, workspace=None, **kwargs):
+        import Dicom_upload
+        super().__init__(name, self._upload, progress=self._progress, **kwargs)
+        self.upload_func = workspace.upload if workspace is not None else functools.partial(Dicom_upload.upload, pdir)
+        self.pdir = pdir
+        self.workspace = workspace
+        self.released = False
+        self.resume = kwargs.get('resume', True)
+        self.total = 0
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def _upload(self, **kwargs):
+        import Dicom_upload
+        self.total = Dicom_upload.pending_sends(self.pdir, resume=self.resume)
+        self.signals.progress.emit(self.name, "Starting upload", 0, self.total)
+        results = self.upload_func(**kwargs)
+        if self.workspace is not None and all(r.ok for r in results.values()):
+            self.workspace.release()
+            self.released = True
+
+        #Sends that turned out not to be needed (same content) or failed never report: end the bar at what was done
+        done = max(self.done, 1)
+        self.signals.progress.emit(self.name, "Upload finished", done, done)
+        return results
+
+    def _progress(self, destination, f, nbytes, seconds):
+        with self._lock:
+            self.done += 1
+            done = self.done
+        MB_per_s = nbytes/1e6/seconds if seconds > 0 else 0.0
+        self.signals.progress.emit(self.name, "%s: %s" % (destination, f), done, self.total)
+        self.signals.throughput.emit(self.name, destination, f, MB_per_s)
+
+
+class JobQueue(QObject):
+    """Keeps track of queued and running jobs (by job id). Jobs start as soon as a pool thread is free"""
+
+    def __init__(self, max_threads=2):
+        super().__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self.jobs = {}
+
+    def submit(self, job):
+        job.setAutoDelete(False)
+        job.signals.finished.connect(lambda *args, job_id=job.id: self._done(job_id))
+        job.signals.failed.connect(lambda *args, job_id=job.id: self._done(job_id))
+        self.jobs[job.id] = job
+        self.pool.start(job)
+        return job
+
+    def _done(self, job_id):
+        self.jobs.pop(job_id, None)
+
+    def cancel_all(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+
+    def running(self):
+        """Names of the queued and running jobs"""
+        return [job.name for job in self.jobs.values()]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Proton stopping power, CSDA range and residual energy lookups.
+
+The stopping power is the power law fit used for the Bragg peak plots,
+S(E) = 205.4*E^-0.722 MeV/cm (E in MeV). The range table R(E) is built once by integrating
+1/S over a fine energy grid; its inverse gives the energy left at a depth, so range, residual
+energy and depth-dose curves for every layer of a plan are one interpolation each:
+
+    R = csda_range(energies)                      cm, any array shape
+    E = residual_energy(energies, depth)          layers x depth, 0 past the end of range
+    dose = depth_dose(energies, depth)            energy lost (MeV) in each depth bin
+
+"""
+
+import numpy as np
+
+
+#Power law stopping power fit (MeV/cm, E in MeV)
+S_COEFF = 205.4
+S_EXP = 0.722
+
+#Energy grid of the tables: geometric from E_MIN to E_MAX MeV, plus E = 0
+E_MIN = 1e-3
+E_MAX = 400.0
+NUM_POINTS = 4000
+
+
+def stopping_power(E):
+    """Stopping power (MeV/cm) at energy E (MeV)"""
+    return S_COEFF*np.power(E, -S_EXP)
+
+
+class RangeTable(object):
+    """CSDA range vs energy on a fine grid, by trapezoidal integration of 1/S(E)"""
+
+    def __init__(self, e_min=E_MIN, e_max=E_MAX, num=NUM_POINTS, stopping_power=stopping_power):
+        self.energy = np.concatenate(([0.0], np.geomspace(e_min, e_max, num)))
+        inv_S = np.zeros_like(self.energy)
+        inv_S[1:] = 1.0/stopping_power(self.energy[1:])
+
+        self.range = np.zeros_like(self.energy)
+        self.range[1:] = np.cumsum(0.5*(inv_S[1:] + inv_S[:-1])*np.diff(self.energy))
+        self.e_max = e_max
+
+    def csda_range(self, E):
+        """Range (cm) of protons with energy E (MeV)"""
+
+        E = np.asarray(E, dtype=float)
+        if np.any(E > self.e_max):
+            raise ValueError("Energy above the range table (%g MeV)" % self.e_max)
+        return np.interp(E, self.energy, self.range)
+
+    def energy_at_range(self, R):
+        """Energy (MeV) of protons with residual range R (cm). 0 for R <= 0"""
+        return np.interp(np.asarray(R, dtype=float), self.range, self.energy, left=0.0)
+
+    def residual_energy(self, E0, depth):
+        """Energy left at each depth (cm) for each initial energy: array of shape E0.shape + depth.shape"""
+
+        E0 = np.asarray(E0, dtype=float)
+        depth = np.asarray(depth, dtype=float)
+        R0 = self.csda_range(E0)
+
+        return self.energy_at_range(R0[...,None] - depth)
+
+    def depth_dose(self, E0, depth):
+        """Energy (MeV) each initial energy loses in each depth bin, layers x depth. Bin k ends at depth[k]
+        (the first bin is empty), matching the step curves of Generate_RTIP_func2.E_depth"""
+
+        E_res = self.residual_energy(E0, depth)
+        dose = np.zeros_like(E_res)
+        dose[...,1:] = E_res[...,:-1] - E_res[...,1:]
+
+        return dose
+
+
+_table = None
+
+def table():
+    """The default RangeTable, built on first use"""
+    global _table
+    if _table is None:
+        _table = RangeTable()
+    return _table
+
+
+def csda_range(E):
+    return table().csda_range(E)
+
+
+def energy_at_range(R):
+    return table().energy_at_range(R)
+
+
+def residual_energy(E0, depth):
+    return table().residual_energy(E0, depth)
+
+
+def depth_dose(E0, depth):
+    return table().depth_dose(E0, depth)
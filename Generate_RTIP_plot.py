@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Plotting helpers for the spot map and Bragg peak axes.
+
+Large plans are drawn with as few artists as possible: all spots in one collection (or a
+2D histogram above a spot count threshold), all layer curves in one LineCollection, and
+artists that change often are redrawn with blitting instead of a full canvas redraw.
+
+"""
+
+import numpy as np
+import matplotlib
+from matplotlib.collections import LineCollection
+
+
+#Above this many spots the spot map is drawn as a 2D histogram
+MAX_SCATTER = 20000
+
+
+def draw_spots(ax, x, y, weights=None, max_points=MAX_SCATTER, bins=200, cmap='viridis', **kwargs):
+    """Draws every spot as a single scatter collection, or bins them into a heatmap in cmap
+    (weighted by Gp if given) when there are more than max_points. kwargs go to the scatter,
+    only alpha also applies to the heatmap"""
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= max_points:
+        return ax.scatter(x, y, **kwargs)
+
+    H, x_edges, y_edges = np.histogram2d(x, y, bins=bins, weights=weights)
+    H = np.ma.masked_equal(H, 0)
+
+    return ax.imshow(H.T, origin='lower', extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]],
+                     aspect='auto', interpolation='nearest', cmap=cmap, alpha=kwargs.get('alpha'))
+
+
+def draw_layer_curves(ax, depth, layer_dose, linewidth=1):
+    """Draws one curve per layer (rows of layer_dose vs depth) as a single LineCollection"""
+
+    layer_dose = np.asarray(layer_dose)
+    segments = np.empty(layer_dose.shape + (2,))
+    segments[:,:,0] = depth
+    segments[:,:,1] = layer_dose
+
+    colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+    lines = LineCollection(segments, colors=colors, linewidths=linewidth)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+
+    return lines
+
+
+class BlitManager(object):
+    """Keeps a copy of the static background and redraws only the registered (animated) artists"""
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self._background = None
+        self._artists = []
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self._artists.append(artist)
+
+    def clear(self):
+        self._artists = []
+
+    def _on_draw(self, event):
+        #Full redraw (resize, pan, zoom): grab the new background and put the artists back on top
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self._artists:
+            artist.figure.draw_artist(artist)
+
+    def update(self):
+        """Redraws the animated artists only"""
+        if self._background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self._background)
+        self._draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Timed spans for the generation and upload stages.
+
+    with trace.span('clone_series', phantom=ct_dir) as s:
+        ...
+        s.add(files=1, bytes=len(payload))
+
+Each finished span records its duration, bytes moved, file count, any exception (which is
+re-raised) and the span it was nested in (per thread). Finished spans go to the listeners
+(e.g. the GUI timing panel) and, if an output file is set, are appended to it as JSON lines:
+
+    trace.set_output('trace.jsonl')     or set RTIP_TRACE=trace.jsonl in the environment
+
+"""
+
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+
+_ids = itertools.count(1)
+_local = threading.local()
+_lock = threading.Lock()
+_listeners = []
+_output = os.environ.get('RTIP_TRACE') or None
+
+
+class Span(object):
+    """One timed stage. bytes/files are added to while it runs, attrs are free-form"""
+
+    def __init__(self, name, parent=None, **attrs):
+        self.id = next(_ids)
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.bytes = 0
+        self.files = 0
+        self.error = None
+        self.start = time.time()
+        self.seconds = None
+        self.thread = threading.current_thread().name
+        self._t0 = time.perf_counter()
+
+    def add(self, bytes=0, files=0):
+        with _lock:
+            self.bytes += bytes
+            self.files += files
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._t0
+
+    def to_dict(self):
+        record = {'id': self.id, 'name': self.name, 'parent': self.parent, 'start': round(self.start, 6),
+                  'seconds': round(self.seconds, 6) if self.seconds is not None else None,
+                  'bytes': self.bytes, 'files': self.files, 'error': self.error, 'thread': self.thread}
+        record.update(('attr_' + k, v if isinstance(v, (int, float, bool, type(None))) else str(v))
+                      for k,v in self.attrs.items())
+        return record
+
+    def __str__(self):
+        text = '%-26s %8.3f s' % (self.name, self.seconds or 0.0)
+        if self.files:
+            text += '  %d files' % self.files
+        if self.bytes:
+            text += '  %.1f MB' % (self.bytes/1e6)
+        if self.error:
+            text += '  FAILED: %s' % self.error
+        return text
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """Innermost open span on this thread, or None"""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def span(name, parent=None, **attrs):
+    """Times the enclosed block. parent defaults to the innermost open span on this thread;
+    pass one explicitly to nest work done on other threads"""
+
+    if parent is None:
+        parent = current()
+    s = Span(name, parent.id if parent is not None else None, **attrs)
+    stack = _stack()
+    stack.append(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        stack.remove(s)
+        s.finish()
+        _emit(s)
+
+
+def add_listener(func):
+    """func(span) is called for every finished span, from the thread that ran it"""
+    _listeners.append(func)
+
+
+def remove_listener(func):
+    if func in _listeners:
+        _listeners.remove(func)
+
+
+def set_output(path):
+    """Appends finished spans to path as JSON lines (None to stop)"""
+    global _output
+    _output = path
+
+
+def _emit(s):
+    if _output:
+        line = json.dumps(s.to_dict())
+        with _lock:
+            with open(_output, 'a') as f:
+                f.write(line + '\n')
+
+    for func in list(_listeners):
+        try:
+            func(s)
+        except Exception:
+            #A broken display must not fail the stage it is reporting on
+            pass
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Timings and peak memory of the plan generation stages on synthetic data.
+
+Generates spot map csvs (beam, energy, -, -, x, y, Gp, -, - like the clinical exports) for every
+combination of --spots and --layers, and a synthetic phantom (CT series plus RTIP), then runs
+each stage headlessly:
+
+    E_depth            depth curve of every layer energy, one energy at a time (empty lookup table)
+    depth_dose_sum     Bragg peak summation shown by load_spot_map
+    from_csv           csv parse
+    csv_check          spot map checks
+    dose_estimator     per-layer Gp totals and stats
+    load_spotmap_warm  load from the binary spot map cache
+    gen_rtip           beam sequences from the clinical csv2xml converter (only when
+                       csv2xml_Clinical_py36.py is in the working directory)
+    replace_iso_gantry_spots   patching the session RTIP with the new plan
+    gen_dicom          cloning the phantom CT series (once, independent of the spot map)
+
+Each stage is timed --repeat times (best run kept) and then run once more under tracemalloc
+for the peak Python allocation. One JSON line per stage and size, to stdout and --out:
+
+    python benchmarks/bench_pipeline.py --spots 1000 100000 1000000 --layers 10 300 --out bench.jsonl
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dicom
+from dicom.dataset import Dataset, FileDataset
+from dicom.sequence import Sequence
+from dicom.UID import generate_uid
+
+import Generate_RTIP_func2 as gen2
+import Generate_RTIP_func3 as gen3
+import Generate_RTIP_cache as cache
+
+
+CT_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.2'
+RTIP_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.481.8'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+
+
+def write_spot_map(path, num_spots, num_layers, beams=1, seed=0):
+    """Writes a synthetic spot map: beams x layers (230 to 70 MeV), spots spread evenly over the layers"""
+
+    rng = np.random.RandomState(seed)
+    beam = np.repeat(np.arange(1, beams+1), num_spots//beams + 1)[:num_spots]
+    layer = (np.arange(num_spots) * num_layers // num_spots)
+    energy = np.round(np.linspace(230, 70, num_layers)[layer], 1)
+
+    data = np.zeros((num_spots, gen2.NUM_COLS))
+    data[:,gen2.BEAM_COL] = beam
+    data[:,gen2.ENERGY_COL] = energy
+    data[:,gen2.X_COL] = rng.uniform(-50, 50, num_spots)
+    data[:,gen2.Y_COL] = rng.uniform(-50, 50, num_spots)
+    data[:,gen2.GP_COL] = rng.uniform(0.1, 1, num_spots)
+
+    np.savetxt(path, data, fmt=['%d', '%.1f', '%d', '%d', '%.2f', '%.2f', '%.3f', '%d', '%d'], delimiter=',',
+               header='beam,energy,a,b,x,y,gp,c,d', comments='')
+
+
+def _file_dataset(path, sop_class, modality):
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = EXPLICIT_VR_LITTLE_ENDIAN
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0'*128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    ds.PatientName = 'Phantom^Bench'
+    ds.PatientID = 'BENCH'
+
+    return ds
+
+
+def synthetic_plan(spot_map):
+    """Fraction Group and Ion Beam Sequences of the synthetic phantom RTIP: one beam per beam number,
+    one control point per layer. A benchmark fixture, not the clinical converter's plan layout"""
+
+    spots = gen2.SpotMap.from_csv(spot_map) if isinstance(spot_map, str) else spot_map
+    beam_starts = np.append(gen2.layer_starts(spots.data[:,gen2.BEAM_COL]), spots.shape[0])
+
+    ibs = Sequence()
+    ref_beams = Sequence()
+    for b in range(len(beam_starts)-1):
+        beam = spots.data[beam_starts[b]:beam_starts[b+1]]
+        starts = np.append(gen2.layer_starts(beam[:,gen2.ENERGY_COL]), len(beam))
+        cps = Sequence()
+        cumulative = 0.0
+        for n in range(len(starts)-1):
+            layer = beam[starts[n]:starts[n+1]]
+            cp = Dataset()
+            cp.ControlPointIndex = str(n)
+            cp.NominalBeamEnergy = '%.10g' % layer[0,gen2.ENERGY_COL]
+            cp.CumulativeMetersetWeight = '%.10g' % cumulative
+            cp.NumberOfScanSpotPositions = str(len(layer))
+            cp.ScanSpotPositionMap = layer[:,[gen2.X_COL,gen2.Y_COL]].ravel().tolist()
+            cp.ScanSpotMetersetWeights = layer[:,gen2.GP_COL].tolist()
+            cumulative += layer[:,gen2.GP_COL].sum()
+            cps.append(cp)
+
+        ion_beam = Dataset()
+        ion_beam.BeamNumber = str(b+1)
+        ion_beam.TreatmentDeliveryType = 'TREATMENT'
+        ion_beam.FinalCumulativeMetersetWeight = '%.10g' % cumulative
+        ion_beam.NumberOfControlPoints = str(len(cps))
+        ion_beam.IonControlPointSequence = cps
+        ibs.append(ion_beam)
+
+        ref_beam = Dataset()
+        ref_beam.ReferencedBeamNumber = str(b+1)
+        ref_beam.BeamMeterset = '%.10g' % cumulative
+        ref_beams.append(ref_beam)
+
+    fraction_group = Dataset()
+    fraction_group.FractionGroupNumber = '1'
+    fraction_group.NumberOfBeams = str(len(ibs))
+    fraction_group.ReferencedBeamSequence = ref_beams
+
+    return Sequence([fraction_group]), ibs
+
+
+def write_phantom(phantom_dir, spot_map, slices=100, size=512, seed=0):
+    """Writes a synthetic phantom: CT series (int16, 2 mm slices) and an RTIP planned from spot_map,
+    in one study and frame of reference"""
+
+    os.makedirs(phantom_dir)
+    rng = np.random.RandomState(seed)
+    study, frame, ct_series = generate_uid(), generate_uid(), generate_uid()
+    for n in range(slices):
+        path = os.path.join(phantom_dir, 'CT%04d.dcm' % n)
+        ds = _file_dataset(path, CT_SOP_CLASS, 'CT')
+        ds.StudyInstanceUID = study
+        ds.SeriesInstanceUID = ct_series
+        ds.FrameOfReferenceUID = frame
+        ds.InstanceNumber = str(n+1)
+        ds.Rows = size
+        ds.Columns = size
+        ds.PixelSpacing = ['1', '1']
+        ds.SliceThickness = '2'
+        ds.ImagePositionPatient = [str(-size/2), str(-size/2), str(2*n)]
+        ds.ImageOrientationPatient = ['1', '0', '0', '0', '1', '0']
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleSlope = '1'
+        ds.RescaleIntercept = '-1024'
+        ds.PixelData = rng.randint(0, 2000, (size, size)).astype(np.int16).tobytes()
+        ds.save_as(path)
+
+    path = os.path.join(phantom_dir, 'RTIP.dcm')
+    ds = _file_dataset(path, RTIP_SOP_CLASS, 'RTPLAN')
+    ds.StudyInstanceUID = study
+    ds.SeriesInstanceUID = generate_uid()
+    ds.FrameOfReferenceUID = frame
+    fgs, ibs = synthetic_plan(spot_map)
+    for beam in ibs:
+        beam.IonControlPointSequence[0].IsocenterPosition = ['0', '0', str(slices)]
+        beam.IonControlPointSequence[0].GantryAngle = '0'
+    ds.FractionGroupSequence = fgs
+    ds.IonBeamSequence = ibs
+    ds.save_as(path)
+
+
+def measure(func, repeat, setup=None):
+    """Best wall time of repeat runs, then the tracemalloc peak (MB) of one more run"""
+
+    best = None
+    for n in range(repeat):
+        args = setup() if setup is not None else ()
+        t0 = time.perf_counter()
+        func(*args)
+        seconds = time.perf_counter() - t0
+        best = seconds if best is None else min(best, seconds)
+
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak/1e6
+
+
+def _record(stage, seconds, peak_mb, items, unit, **params):
+    record = {'bench': 'pipeline', 'stage': stage, 'seconds': round(seconds, 6), 'peak_mb': round(peak_mb, 3),
+              'items': items, 'unit': unit, 'per_second': round(items/seconds, 1) if seconds > 0 else None}
+    record.update(params)
+    return record
+
+
+def bench_spot_map(csv_file, num_spots, num_layers, session_rtip, work_dir, repeat):
+    """All spot map stages for one csv. Yields records"""
+
+    params = {'spots': num_spots, 'layers': num_layers}
+    spots = gen2.SpotMap.from_csv(csv_file)
+    name, data, dose_array, stats = gen2.dose_estimator(spots)
+    energies = dose_array[:,0]
+
+    def E_depth_all():
+        for E0 in energies:
+            gen2.E_depth(E0)
+
+    #E_depth keeps computed curves in a module level table, empty it so every run computes them
+    def empty_depth_table():
+        gen2._depth_table.clear()
+        return ()
+
+    stages = [
+        ('E_depth', E_depth_all, empty_depth_table, len(energies), 'layers'),
+        ('depth_dose_sum', lambda: gen2.depth_dose_sum(dose_array[:,0], dose_array[:,1]), None, len(energies), 'layers'),
+        ('from_csv', lambda: gen2.SpotMap.from_csv(csv_file), None, num_spots, 'spots'),
+        ('csv_check', lambda: gen2.csv_check(csv_file), None, num_spots, 'spots'),
+        ('dose_estimator', lambda: gen2.dose_estimator(spots), None, num_spots, 'spots'),
+    ]
+
+    cache_dir = os.path.join(work_dir, 'spotmap_cache')
+    cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    stages.append(('load_spotmap_warm', lambda: cache.load_spotmap(csv_file, cache_dir=cache_dir), None, num_spots, 'spots'))
+
+    #The production plan path, which needs the clinical converter
+    if os.path.isfile(gen2.CSV2XML_SCRIPT):
+        stages.append(('gen_rtip', lambda: gen2.gen_rtip(spots, work_dir), None, num_spots, 'spots'))
+
+    #Patch a fresh copy of the phantom RTIP each run
+    session_dir = os.path.join(work_dir, 'session')
+    fgs, ibs = synthetic_plan(spots)
+    def fresh_session():
+        if os.path.isdir(session_dir):
+            shutil.rmtree(session_dir)
+        os.makedirs(session_dir)
+        shutil.copy(session_rtip, session_dir)
+        return session_dir, '10', '20', '30', '90', fgs, ibs
+    stages.append(('replace_iso_gantry_spots', gen3.replace_iso_gantry_spots, fresh_session, num_spots, 'spots'))
+
+    for stage, func, setup, items, unit in stages:
+        seconds, peak_mb = measure(func, repeat, setup)
+        yield _record(stage, seconds, peak_mb, items, unit, **params)
+
+
+def bench_clone(phantom_dir, work_dir, repeat, workers):
+    """Cloning the phantom into a new session (gen_dicom writes into the working directory)"""
+
+    files = os.listdir(phantom_dir)
+    total_bytes = sum(os.path.getsize(os.path.join(phantom_dir, f)) for f in files)
+    session_dir = os.path.join(work_dir, 'Bench_Clone')
+
+    def clean():
+        if os.path.isdir(session_dir):
+            shutil.rmtree(session_dir)
+        return ()
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        seconds, peak_mb = measure(lambda: gen3.gen_dicom('Bench', 'Clone', phantom_dir, workers=workers), repeat, clean)
+    finally:
+        os.chdir(cwd)
+
+    return _record('gen_dicom', seconds, peak_mb, len(files), 'files', MB=round(total_bytes/1e6, 2),
+                   MB_per_second=round(total_bytes/1e6/seconds, 1), workers=workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan generation stage timings on synthetic data (JSON lines)')
+    parser.add_argument('--spots', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='spot map sizes')
+    parser.add_argument('--layers', type=int, nargs='+', default=[10, 100, 300], help='layers per spot map')
+    parser.add_argument('--ct-slices', type=int, default=100, help='phantom CT slices')
+    parser.add_argument('--ct-size', type=int, default=512, help='phantom CT rows/columns')
+    parser.add_argument('--workers', type=int, default=8, help='threads for cloning the CT series')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (best is kept)')
+    parser.add_argument('--quick', action='store_true', help='1000 and 10000 spots, 10 layers, 20 small CT slices, 1 run')
+    parser.add_argument('--out', default=None, help='also append the JSON lines to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data directory')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.spots, args.layers, args.ct_slices, args.ct_size, args.repeat = [1000, 10000], [10], 20, 128, 1
+
+    work_dir = tempfile.mkdtemp(prefix='rtip_bench_')
+    out = open(args.out, 'a') if args.out else None
+    env = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+           'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def emit(record):
+        record.update(env)
+        line = json.dumps(record)
+        print(line)
+        sys.stdout.flush()
+        if out is not None:
+            out.write(line + '\n')
+            out.flush()
+
+    try:
+        plan_csv = os.path.join(work_dir, 'phantom_plan.csv')
+        write_spot_map(plan_csv, 1000, 10)
+        phantom_dir = os.path.join(work_dir, 'Phantom') + '/'
+        write_phantom(phantom_dir, plan_csv, args.ct_slices, args.ct_size)
+
+        emit(bench_clone(phantom_dir, work_dir, args.repeat, args.workers))
+
+        for num_spots in args.spots:
+            for num_layers in args.layers:
+                if num_layers > num_spots:
+                    continue
+                csv_file = os.path.join(work_dir, 'spots_%d_%d.csv' % (num_spots, num_layers))
+                write_spot_map(csv_file, num_spots, num_layers)
+                for record in bench_spot_map(csv_file, num_spots, num_layers, phantom_dir + 'RTIP.dcm', work_dir, args.repeat):
+                    emit(record)
+    finally:
+        if out is not None:
+            out.close()
+        if args.keep:
+            print('Synthetic data kept in %s' % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
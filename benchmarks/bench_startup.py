@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Startup time of the GUI (time to first paint) and of the command line tool.
+
+Each run starts a fresh interpreter. The GUI is started with --time-startup, which prints the
+time from the start of the module to the first pass of the event loop after the window is
+shown, then quits. Runs offscreen unless QT_QPA_PLATFORM is already set. One JSON line per run:
+
+    python benchmarks/bench_startup.py --repeat 5 --workdir /path/containing/MGH_Phantoms
+
+Also reports which slow modules (matplotlib, dicom, paramiko, numpy) are loaded before the
+window appears; none of them should be.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['numpy', 'matplotlib', 'dicom', 'pydicom', 'paramiko']
+
+#Imports the GUI module without starting the window and lists the slow modules it pulled in
+IMPORT_CHECK = ("import sys, json; import Generate_RTIP_GUI; "
+                "print(json.dumps(sorted(m for m in %r if m in sys.modules)))" % HEAVY)
+
+
+def _run(cmd, cwd):
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    t0 = time.perf_counter()
+    out = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True, check=True).stdout
+    return out, time.perf_counter() - t0
+
+
+def gui_startup(cwd):
+    out, wall = _run([sys.executable, os.path.join(ROOT, 'Generate_RTIP_GUI.py'), '--time-startup'], cwd)
+    first_paint = [float(line.split()[1]) for line in out.splitlines() if line.startswith('startup_seconds')]
+    return {'bench': 'gui_startup', 'first_paint_seconds': first_paint[0] if first_paint else None,
+            'wall_seconds': round(wall, 4)}
+
+
+def cli_startup(cwd):
+    out, wall = _run([sys.executable, os.path.join(ROOT, 'Generate_RTIP_cli.py'), '--help'], cwd)
+    return {'bench': 'cli_startup', 'wall_seconds': round(wall, 4)}
+
+
+def gui_imports(cwd):
+    out, wall = _run([sys.executable, '-c', IMPORT_CHECK], cwd)
+    return {'bench': 'gui_imports', 'heavy_modules': json.loads(out.splitlines()[-1]), 'wall_seconds': round(wall, 4)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GUI and command line startup times')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--workdir', default=None,
+                        help='directory containing MGH_Phantoms/ to start the GUI in (default: repository root)')
+    args = parser.parse_args(argv)
+
+    cwd = args.workdir or ROOT
+    print(json.dumps(gui_imports(cwd)))
+    for bench in (gui_startup, cli_startup):
+        for n in range(args.repeat):
+            result = bench(cwd)
+            result['run'] = n
+            print(json.dumps(result))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+The modules live at the top of the repository, next to the GUI. Run from there:
+
+    python -m pytest -q tests
+
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
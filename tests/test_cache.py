@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+The binary spot map cache: hits are memory-mapped, damaged or outdated entries are rebuilt.
+"""
+
+import os
+import json
+
+import numpy as np
+
+import Generate_RTIP_cache as cache
+
+
+def write_csv(path, spots=200, layers=5):
+    rng = np.random.RandomState(0)
+    data = np.zeros((spots, 9))
+    data[:,0] = 1
+    data[:,1] = np.repeat(np.linspace(200, 100, layers), spots//layers)
+    data[:,4:6] = rng.uniform(-50, 50, (spots, 2))
+    data[:,6] = rng.uniform(0.1, 1, spots)
+    np.savetxt(str(path), data, delimiter=',', fmt='%g', header='beam,energy,a,b,x,y,gp,c,d', comments='')
+    return str(path)
+
+
+def entry_of(csv_file, cache_dir):
+    return os.path.join(cache_dir, cache.file_hash(csv_file))
+
+
+def test_cache_hit_is_memory_mapped(tmp_path):
+    csv_file, cache_dir = write_csv(tmp_path / 'plan.csv'), str(tmp_path / 'cache')
+
+    first = cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    second = cache.load_spotmap(csv_file, cache_dir=cache_dir)
+
+    assert not isinstance(first.spots.data, np.memmap)
+    assert isinstance(second.spots.data, np.memmap)
+    np.testing.assert_array_equal(first.spots.data, second.spots.data)
+    np.testing.assert_array_equal(first.dose_sum, second.dose_sum)
+
+
+def test_damaged_entry_is_rebuilt(tmp_path):
+    csv_file, cache_dir = write_csv(tmp_path / 'plan.csv'), str(tmp_path / 'cache')
+    cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    os.remove(os.path.join(entry_of(csv_file, cache_dir), 'depth.npy'))
+
+    rebuilt = cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    assert not isinstance(rebuilt.spots.data, np.memmap)
+
+    #The next load is a hit again
+    hit = cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    assert isinstance(hit.spots.data, np.memmap)
+    np.testing.assert_array_equal(hit.depth, rebuilt.depth)
+
+
+def test_entry_of_another_version_is_replaced(tmp_path):
+    csv_file, cache_dir = write_csv(tmp_path / 'plan.csv'), str(tmp_path / 'cache')
+    cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    meta_path = os.path.join(entry_of(csv_file, cache_dir), 'meta.json')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['version'] = cache.CACHE_VERSION - 1
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    cache.load_spotmap(csv_file, cache_dir=cache_dir)
+    with open(meta_path) as f:
+        assert json.load(f)['version'] == cache.CACHE_VERSION
+    assert isinstance(cache.load_spotmap(csv_file, cache_dir=cache_dir).spots.data, np.memmap)
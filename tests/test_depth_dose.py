@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+The vectorised spot map and depth-dose functions against the loops they replaced. The reference
+loops are the original E_depth, dose_estimator and Bragg peak sum of load_spot_map, kept as they
+were apart from dose_estimator no longer writing its text summary.
+"""
+
+import numpy as np
+import pytest
+
+import Generate_RTIP_func2 as gen2
+import Generate_RTIP_physics as physics
+
+
+def baseline_E_depth(E0):
+    E_vs_depth = [E0]
+    depth_list = [0]
+    dose_list = [0]
+    step = 0.25
+    depth = step
+
+    for i in range(500):
+        E_next = E_vs_depth[-1] - gen2.dE_dx(E_vs_depth[-1])*step
+        if E_next > 0:
+            dose_list.append(gen2.dE_dx(E_vs_depth[-1])*step)
+            E_vs_depth.append(E_next)
+            depth_list.append(depth)
+            depth += step
+        else:
+            dose_list.extend((E_vs_depth[-1],0))
+            E_vs_depth.extend((0,0))
+            depth_list.extend((depth, depth+step))
+            break
+
+    return np.column_stack((np.asarray(depth_list), np.asarray(E_vs_depth), np.asarray(dose_list)))
+
+
+def baseline_bragg_sum(energies, weights, curve, num_depths):
+    BP_sum = np.zeros(num_depths)
+    for n,e in enumerate(energies):
+        dose = curve(e)
+        for m in range(len(dose)):
+            BP_sum[m] += dose[m]*weights[n]
+    return BP_sum
+
+
+def baseline_dose_estimator(file):
+    data = np.genfromtxt(file, delimiter=',', filling_values=np.nan, usecols=(1,4,5,6))
+    data = data[~np.isnan(data).any(axis=1)]
+
+    energy_current = data[0,0]
+    num_spots,foo = data.shape
+    dose_Gp = 0
+    num_layers = 1
+    dose_array = []
+
+    for i in range(num_spots):
+        energy = data[i,0]
+        if energy != energy_current:
+            num_layers += 1
+            dose_array.append([data[i-1,0],dose_Gp])
+            dose_Gp = data[i,3]
+            energy_current = energy
+        elif i == (num_spots-1):
+            dose_Gp += data[i,3]
+            dose_array.append([data[i-1,0],dose_Gp])
+        else:
+            dose_Gp += data[i,3]
+
+    return data, np.asarray(dose_array), num_spots, num_layers
+
+
+def write_spot_map(path, layers, spots_per_layer, seed=0):
+    """Clinical style spot map: header, beam, energy, -, -, x, y, Gp, -, -"""
+
+    rng = np.random.RandomState(seed)
+    energies = np.repeat(np.linspace(200, 90, layers).round(1), spots_per_layer)
+    n = len(energies)
+    data = np.column_stack((np.ones(n), energies, np.zeros(n), np.zeros(n), rng.uniform(-50, 50, n).round(2),
+                            rng.uniform(-50, 50, n).round(2), rng.uniform(0.01, 2, n).round(4), np.zeros(n), np.zeros(n)))
+    with open(str(path), 'w') as f:
+        f.write('beam,energy,a,b,x,y,gp,c,d\n')
+        np.savetxt(f, data, delimiter=',', fmt='%g')
+
+    return str(path)
+
+
+@pytest.mark.parametrize('E0', [3.0, 70.0, 115.3, 160.0, 228.0])
+def test_E_depth_matches_baseline(E0):
+    np.testing.assert_allclose(gen2.E_depth(E0), baseline_E_depth(E0), rtol=1e-12, atol=1e-12)
+
+
+def test_E_depth_matches_baseline_after_batch_lookup():
+    #Curves cached by a shorter batch call must not shorten E_depth
+    gen2.E_depth_batch([150.0, 200.0], n_steps=10)
+    for E0 in (150.0, 200.0):
+        np.testing.assert_allclose(gen2.E_depth(E0), baseline_E_depth(E0), rtol=1e-12, atol=1e-12)
+
+
+def test_depth_dose_sum_matches_layer_loop():
+    energies = np.array([200.0, 180.0, 180.0, 150.0, 100.0])
+    weights = np.array([1.5, 0.2, 0.3, 2.0, 0.7])
+
+    depth, dose_sum, layer_dose = gen2.depth_dose_sum(energies, weights)
+    curve = lambda e: physics.depth_dose([e], depth)[0]
+
+    np.testing.assert_allclose(dose_sum, baseline_bragg_sum(energies, weights, curve, len(depth)), rtol=1e-12)
+    np.testing.assert_allclose(layer_dose.sum(axis=0), dose_sum, rtol=1e-12)
+    for n,e in enumerate(energies):
+        np.testing.assert_allclose(layer_dose[n], curve(e)*weights[n], rtol=1e-12)
+
+
+def test_depth_dose_sum_agrees_with_baseline_sum():
+    #The range table replaced the stepped curves: same deposited energy, same peak to a bin or two
+    energies = np.array([220.0, 190.0, 160.0, 130.0])
+    weights = np.array([0.5, 1.0, 1.5, 2.0])
+
+    depth, dose_sum, layer_dose = gen2.depth_dose_sum(energies, weights)
+    ref_sum = baseline_bragg_sum(energies, weights, lambda e: baseline_E_depth(e)[:,2], 200)
+
+    np.testing.assert_allclose(dose_sum.sum(), ref_sum.sum(), rtol=1e-9)
+    np.testing.assert_allclose(dose_sum.sum(), np.dot(weights, energies), rtol=1e-9)
+    assert depth[-1] >= gen2.layer_ranges(energies).max()
+    for n,e in enumerate(energies):
+        ref_peak = baseline_E_depth(e)
+        assert abs(depth[np.argmax(layer_dose[n])] - ref_peak[np.argmax(ref_peak[:,2]),0]) <= 0.5
+
+
+def test_depth_dose_sum_empty_plan():
+    depth, dose_sum, layer_dose = gen2.depth_dose_sum([], [])
+    assert depth.shape == (0,) and dose_sum.shape == (0,) and layer_dose.shape == (0, 0)
+
+    depth, dose_sum, layer_dose = gen2.depth_dose_sum([], [], max_depth=10)
+    assert len(depth) == 41 and not dose_sum.any() and layer_dose.shape == (0, 41)
+
+
+@pytest.mark.parametrize('layers,spots', [(1, 5), (8, 3), (30, 40)])
+def test_dose_estimator_matches_baseline(tmp_path, layers, spots):
+    csv_file = write_spot_map(tmp_path / 'plan.csv', layers, spots)
+
+    name, data, dose_array, stats = gen2.dose_estimator(csv_file)
+    ref_data, ref_dose_array, num_spots, num_layers = baseline_dose_estimator(csv_file)
+
+    assert name == 'plan.csv'
+    np.testing.assert_allclose(data, ref_data)
+    np.testing.assert_allclose(dose_array, ref_dose_array)
+    assert stats.num_spots == num_spots
+    assert stats.num_layers == num_layers
+    np.testing.assert_allclose(stats.total_Gp, ref_dose_array[:,1].sum())
+    np.testing.assert_allclose(stats.energies, np.unique(ref_dose_array[:,0]))
+
+
+def test_dose_estimator_keeps_single_spot_last_layer(tmp_path):
+    #The baseline loop dropped a last layer with one spot
+    csv_file = write_spot_map(tmp_path / 'plan.csv', 3, 4)
+    with open(csv_file, 'a') as f:
+        f.write('1,80,0,0,1,2,0.5,0,0\n')
+
+    name, data, dose_array, stats = gen2.dose_estimator(csv_file)
+    ref_data, ref_dose_array, num_spots, num_layers = baseline_dose_estimator(csv_file)
+
+    np.testing.assert_allclose(dose_array[:-1], ref_dose_array)
+    np.testing.assert_allclose(dose_array[-1], [80, 0.5])
+    assert stats.num_layers == num_layers == 4
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+The phantom index: small fields in a JSON file in the cache directory, spot maps in .npy files next
+to it, and the RTIP only re-read (Generate_RTIP_func1 replaced by a stand-in) when a phantom changes.
+"""
+
+import os
+import sys
+import json
+import types
+
+import numpy as np
+import pytest
+
+import Generate_RTIP_index as index
+
+
+SPOT_MAP = [[100.0, 1.0, 2.0, 1.0], [100.0, 3.0, 4.0, 1.0], [90.0, 5.0, 6.0, 1.0]]
+
+
+@pytest.fixture
+def rtip_reads(tmp_path, monkeypatch):
+    """Stand-in Generate_RTIP_func1, returns the phantoms whose RTIP was read"""
+
+    reads = []
+    specs = tmp_path / 'specs.txt'
+    specs.write_text('Num Spots = 3')
+
+    def plot_rtip_map(phantom_dir):
+        reads.append(os.path.basename(os.path.dirname(phantom_dir)))
+        return str(specs), SPOT_MAP
+
+    gen1 = types.ModuleType('Generate_RTIP_func1')
+    gen1.get_phantom_list = lambda p: sorted(d for d in os.listdir(p) if not d.startswith('.'))
+    gen1.get_isocenter = lambda phantom_dir: ([1.0, 2.0, 3.0], 0.0, 'ok')
+    gen1.plot_rtip_map = plot_rtip_map
+    monkeypatch.setitem(sys.modules, 'Generate_RTIP_func1', gen1)
+    return reads
+
+
+@pytest.fixture
+def phantoms(tmp_path):
+    phantom_path = tmp_path / 'MGH_Phantoms'
+    for name in ('A', 'B'):
+        (phantom_path / name).mkdir(parents=True)
+        (phantom_path / name / 'RTIP.dcm').write_bytes(b'plan ' + name.encode())
+    return str(phantom_path) + '/', str(tmp_path / 'cache')
+
+
+def test_index_is_kept_out_of_the_phantom_directory(phantoms, rtip_reads):
+    phantom_path, index_dir = phantoms
+
+    info = index.PhantomIndex(phantom_path, index_dir).get('A')
+
+    assert info['isocenter'] == ['1.0', '2.0', '3.0'] and info['gantry_angle'] == '0.0'
+    assert info['specs'] == 'Num Spots = 3'
+    np.testing.assert_array_equal(info['spot_map'], SPOT_MAP)
+    assert sorted(os.listdir(phantom_path)) == ['A', 'B']
+    assert sorted(os.listdir(index_dir)) == sorted([index.INDEX_NAME, index._spot_map_name('A')])
+
+    #The spot map isn't in the JSON, only the name of its file
+    with open(os.path.join(index_dir, index.INDEX_NAME)) as f:
+        entry = json.load(f)['entries']['A'][1]
+    assert entry['spot_map'] == index._spot_map_name('A')
+
+
+def test_unchanged_phantom_is_not_re_read(phantoms, rtip_reads):
+    phantom_path, index_dir = phantoms
+    index.PhantomIndex(phantom_path, index_dir).get('A')
+
+    ix = index.PhantomIndex(phantom_path, index_dir)
+    assert ix.phantom_list() == ['A', 'B']
+    np.testing.assert_array_equal(ix.get('A')['spot_map'], SPOT_MAP)
+    assert rtip_reads == ['A']
+
+    #Editing a phantom re-reads only that phantom
+    with open(os.path.join(phantom_path, 'A', 'RTIP.dcm'), 'ab') as f:
+        f.write(b' edited')
+    ix = index.PhantomIndex(phantom_path, index_dir)
+    ix.get('A')
+    ix.get('B')
+    ix.get('B')
+    assert rtip_reads == ['A', 'A', 'B']
+
+
+@pytest.mark.parametrize('damaged', [index.INDEX_NAME, 'spot_map'])
+def test_damaged_index_is_a_miss(phantoms, rtip_reads, damaged):
+    phantom_path, index_dir = phantoms
+    index.PhantomIndex(phantom_path, index_dir).get('A')
+
+    name = index._spot_map_name('A') if damaged == 'spot_map' else damaged
+    with open(os.path.join(index_dir, name), 'wb') as f:
+        f.write(b'{not an index')
+
+    info = index.PhantomIndex(phantom_path, index_dir).get('A')
+    np.testing.assert_array_equal(info['spot_map'], SPOT_MAP)
+    assert rtip_reads == ['A', 'A']
+
+    index.PhantomIndex(phantom_path, index_dir).get('A')
+    assert rtip_reads == ['A', 'A']
+
+
+def test_unwritable_cache_directory(phantoms, rtip_reads, tmp_path):
+    phantom_path, index_dir = phantoms
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+
+    ix = index.PhantomIndex(phantom_path, str(blocker / 'cache'))
+    assert ix.phantom_list() == ['A', 'B']
+    np.testing.assert_array_equal(ix.get('A')['spot_map'], SPOT_MAP)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+build_session on the benchmark's synthetic phantom: a few small CT slices and an RTIP.
+"""
+
+import os
+
+import pytest
+
+dicom = pytest.importorskip('dicom')
+
+import Generate_RTIP_func3 as gen3
+from benchmarks import bench_pipeline
+
+
+@pytest.fixture
+def phantom(tmp_path):
+    spot_map = str(tmp_path / 'plan.csv')
+    bench_pipeline.write_spot_map(spot_map, 60, 3)
+    phantom_dir = str(tmp_path / 'Head') + '/'
+    bench_pipeline.write_phantom(phantom_dir, spot_map, slices=4, size=8)
+    return phantom_dir
+
+
+def build(phantom_dir, tmp_path, **kwargs):
+    return gen3.build_session(phantom_dir, 'Jane', 'Doe', session=str(tmp_path / 'Jane_Doe'), **kwargs)
+
+
+def session_rtip(tmp_path):
+    return dicom.read_file(str(tmp_path / 'Jane_Doe' / 'RTIP.dcm'))
+
+
+def geometry(rtip):
+    cp = rtip.IonBeamSequence[0].IonControlPointSequence[0]
+    return [float(v) for v in cp.IsocenterPosition], float(cp.GantryAngle)
+
+
+def test_zero_geometry_is_applied(phantom, tmp_path):
+    build(phantom, tmp_path, x=10, y=20, z=30, angle=90)
+    assert geometry(session_rtip(tmp_path)) == ([10, 20, 30], 90)
+
+    #0 is a new angle and isocenter, not "keep the old one"
+    workspace = build(phantom, tmp_path, x=0, y=0, z=0, angle=0)
+    assert workspace.done_msg.startswith('RTIP updated')
+    assert geometry(session_rtip(tmp_path)) == ([0, 0, 0], 0)
+
+    workspace = build(phantom, tmp_path, x=0, y=0, z=0, angle=0)
+    assert workspace.done_msg.endswith('is up to date')
+
+
+UID_KEYWORDS = ('SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID', 'FrameOfReferenceUID')
+
+
+def read_series(directory, files):
+    return dict((f, dicom.read_file(os.path.join(directory, f))) for f in files)
+
+
+def test_session_has_fresh_uids_with_consistent_references(phantom, tmp_path):
+    build(phantom, tmp_path)
+    files = sorted(os.listdir(phantom))
+    old = read_series(phantom, files)
+    new = read_series(str(tmp_path / 'Jane_Doe'), files)
+
+    #No UID of the phantom is left, class UIDs aren't instance UIDs
+    phantom_uids = set(getattr(ds, k) for ds in old.values() for k in UID_KEYWORDS)
+    assert not phantom_uids & set(getattr(ds, k) for ds in new.values() for k in UID_KEYWORDS)
+    assert all(new[f].SOPClassUID == old[f].SOPClassUID for f in files)
+
+    #Every file its own instance, matching its file meta
+    assert len(set(ds.SOPInstanceUID for ds in new.values())) == len(files)
+    assert all(ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID for ds in new.values())
+
+    #Still one study and frame of reference, the CT slices one series and the RTIP another
+    assert len(set(ds.StudyInstanceUID for ds in new.values())) == 1
+    assert len(set(ds.FrameOfReferenceUID for ds in new.values())) == 1
+    ct_series = set(ds.SeriesInstanceUID for f,ds in new.items() if f.startswith('CT'))
+    assert len(ct_series) == 1 and new['RTIP.dcm'].SeriesInstanceUID not in ct_series
+
+
+def test_every_session_gets_its_own_uids(phantom, tmp_path):
+    build(phantom, tmp_path)
+    gen3.build_session(phantom, 'John', 'Doe', session=str(tmp_path / 'John_Doe'))
+
+    first = read_series(str(tmp_path / 'Jane_Doe'), ['CT0000.dcm', 'RTIP.dcm'])
+    second = read_series(str(tmp_path / 'John_Doe'), ['CT0000.dcm', 'RTIP.dcm'])
+    assert not (set(getattr(ds, k) for ds in first.values() for k in UID_KEYWORDS) &
+                set(getattr(ds, k) for ds in second.values() for k in UID_KEYWORDS))
+
+
+def test_uid_map_is_shared_by_the_files_of_a_session():
+    uids = gen3.UidMap()
+    assert uids('1.2.3') == uids('1.2.3') != uids('1.2.4')
+    assert gen3.UidMap(uids.mapping)('1.2.3') == uids('1.2.3')
+
+
+def rewritten(tmp_path, build_again):
+    """Files of the session written by build_again()"""
+
+    session = str(tmp_path / 'Jane_Doe')
+    for f in gen3.session_files(session):
+        os.utime(os.path.join(session, f), (0, 0))
+    workspace = build_again()
+    files = gen3.session_files(session)
+    return workspace, sorted(f for f in files if os.stat(os.path.join(session, f)).st_mtime != 0)
+
+
+def test_identical_inputs_leave_the_session_untouched(phantom, tmp_path):
+    build(phantom, tmp_path, angle=90)
+
+    workspace, files = rewritten(tmp_path, lambda: build(phantom, tmp_path, angle=90))
+    assert workspace.done_msg == 'Session %s is up to date' % (tmp_path / 'Jane_Doe')
+    assert files == []
+
+
+def test_new_geometry_only_rewrites_the_rtip(phantom, tmp_path):
+    build(phantom, tmp_path, angle=90)
+    before = read_series(str(tmp_path / 'Jane_Doe'), ['RTIP.dcm'])['RTIP.dcm']
+
+    workspace, files = rewritten(tmp_path, lambda: build(phantom, tmp_path, x=1, y=2, z=3, angle=180))
+    assert workspace.done_msg.startswith('RTIP updated') and files == ['RTIP.dcm']
+
+    #Same patient and UIDs, new geometry on the phantom plan
+    after = session_rtip(tmp_path)
+    assert geometry(after) == ([1, 2, 3], 180)
+    assert [getattr(after, k) for k in UID_KEYWORDS + ('PatientID',)] == \
+           [getattr(before, k) for k in UID_KEYWORDS + ('PatientID',)]
+
+
+def test_new_plan_only_rewrites_the_rtip(phantom, tmp_path):
+    build(phantom, tmp_path)
+    spot_map = str(tmp_path / 'other.csv')
+    bench_pipeline.write_spot_map(spot_map, 40, 5)
+    plan = bench_pipeline.synthetic_plan(spot_map)
+
+    workspace, files = rewritten(tmp_path, lambda: build(phantom, tmp_path, plan=plan))
+    assert workspace.done_msg.startswith('RTIP updated') and files == ['RTIP.dcm']
+
+    #The phantom plan's geometry is kept for the new plan
+    rtip = session_rtip(tmp_path)
+    assert len(rtip.IonBeamSequence[0].IonControlPointSequence) == 5
+    assert geometry(rtip) == ([0, 0, 4], 0)
+
+
+def test_changed_phantom_is_cloned_again(phantom, tmp_path):
+    build(phantom, tmp_path)
+    old_ct = read_series(str(tmp_path / 'Jane_Doe'), ['CT0000.dcm'])['CT0000.dcm']
+
+    #A slice less in the phantom: everything is cloned again and the old slice removed
+    os.remove(os.path.join(phantom, 'CT0003.dcm'))
+    workspace, files = rewritten(tmp_path, lambda: build(phantom, tmp_path))
+    assert workspace.done_msg.startswith('Data saved')
+    assert files == ['CT0000.dcm', 'CT0001.dcm', 'CT0002.dcm', 'RTIP.dcm']
+    assert gen3.session_files(str(tmp_path / 'Jane_Doe')) == files
+
+    new_ct = read_series(str(tmp_path / 'Jane_Doe'), ['CT0000.dcm'])['CT0000.dcm']
+    assert new_ct.SOPInstanceUID != old_ct.SOPInstanceUID
+
+    #A different phantom too
+    spot_map = str(tmp_path / 'plan.csv')
+    other = str(tmp_path / 'Pelvis') + '/'
+    bench_pipeline.write_phantom(other, spot_map, slices=2, size=8)
+    workspace, files = rewritten(tmp_path, lambda: build(other, tmp_path))
+    assert workspace.done_msg.startswith('Data saved')
+    assert files == gen3.session_files(str(tmp_path / 'Jane_Doe')) == ['CT0000.dcm', 'CT0001.dcm', 'RTIP.dcm']
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Dicom_upload against in-process destinations: PacsSink talking to a stand-in PACS host (paramiko's
+SSHClient and SFTP channels replaced by fakes) instead of a real one, and a sink recording what it
+is sent for the parts of transfer that don't depend on the destination.
+"""
+
+import os
+import socket
+import threading
+
+import pytest
+
+import Dicom_upload
+from Dicom_upload import PacsSink, TransferManifest, transfer
+
+
+class FakeStream(object):
+    def __init__(self, lines=(), status=0):
+        self.lines = list(lines)
+        self.channel = self
+        self.status = status
+
+    def readlines(self):
+        return self.lines
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class FakeSSHClient(object):
+    """paramiko.SSHClient connected to the stand-in host. The push script exits with host['status']"""
+
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+        host['clients'].append(self)
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, hostname, username, password):
+        if self.host['refuse']:
+            raise socket.error("Connection refused")
+        self.host['logins'].append((hostname, username, password))
+
+    def exec_command(self, command):
+        self.host['commands'].append(command)
+        status = self.host['status'] if command.startswith('./upload_session_data_to_pacs.sh') else 0
+        errors = ['push failed\n'] if status else []
+        return None, FakeStream(['ok\n'], status), FakeStream(errors)
+
+    def get_transport(self):
+        return self.host
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSFTP(object):
+    """One SFTP channel writing into the host's files. The first host['broken'] puts over all channels fail"""
+
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+        host['channels'].append(self)
+
+    def putfo(self, fl, remotepath, file_size):
+        with self.host['lock']:
+            if self.host['broken'] > 0:
+                self.host['broken'] -= 1
+                raise IOError("channel closed")
+            self.host['files'][remotepath] = fl.read()
+        assert len(self.host['files'][remotepath]) == file_size
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSink(object):
+    """Records what an upload does to a destination. Files in fail_on raise on send"""
+
+    def __init__(self, name, workers=1, fail_on=()):
+        self.name = name
+        self.workers = workers
+        self.retry_count = 0
+        self.fail_on = set(fail_on)
+        self.sent = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        self.events.append('open')
+
+    def send(self, f, payload):
+        if f in self.fail_on:
+            raise IOError("Could not send %s" % f)
+        with self._lock:
+            self.sent[f] = payload
+
+    def close(self):
+        self.events.append('close')
+
+    def abort(self):
+        self.events.append('abort')
+
+
+@pytest.fixture
+def pacs_host(monkeypatch):
+    paramiko = pytest.importorskip('paramiko')
+    host = {'files': {}, 'broken': 0, 'status': 0, 'refuse': False, 'lock': threading.Lock(),
+            'clients': [], 'channels': [], 'commands': [], 'logins': []}
+
+    monkeypatch.setattr(paramiko, 'SSHClient', lambda: FakeSSHClient(host))
+    monkeypatch.setattr(paramiko.SFTPClient, 'from_transport', staticmethod(FakeSFTP))
+    return host
+
+
+PACS_INFO = {'address': 'pacs-host', 'username': 'user', 'password': 'secret'}
+
+
+def make_session(tmp_path, names=('CT000.dcm', 'CT001.dcm', 'CT002.dcm', 'RTIP.dcm')):
+    session = tmp_path / 'A_B'
+    session.mkdir()
+    for n,f in enumerate(names):
+        (session / f).write_bytes(os.urandom(64 + n))
+    return str(session) + '/', list(names)
+
+
+def run(session, files, sinks, **kwargs):
+    return transfer(session, files, sinks, TransferManifest(session), **kwargs)
+
+
+def test_pacs_sink_sends_over_pooled_channels(tmp_path, pacs_host):
+    session, files = make_session(tmp_path)
+    pacs_host['broken'] = 1
+
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)])
+
+    #One connection, the session directory made before the files and pushed on after them
+    assert results['PACS'].ok and results['PACS'].files == 4 and results['PACS'].retries == 1
+    assert pacs_host['logins'] == [('pacs-host', 'user', 'secret')]
+    assert pacs_host['commands'] == ['cd sessions; mkdir %s; ls' % session,
+                                     './upload_session_data_to_pacs.sh ~/sessions/' + session]
+    assert sorted(pacs_host['files']) == sorted('sessions/' + session + f for f in files)
+    for f in files:
+        with open(os.path.join(session, f), 'rb') as local:
+            assert pacs_host['files']['sessions/' + session + f] == local.read()
+
+    #At most one channel per worker, plus the one replacing the broken channel
+    assert len(pacs_host['channels']) <= 3
+    assert all(channel.closed for channel in pacs_host['channels'])
+    assert [client.closed for client in pacs_host['clients']] == [True]
+
+
+def test_pacs_sink_reports_a_failed_connection(tmp_path, pacs_host):
+    session, files = make_session(tmp_path)
+    pacs_host['refuse'] = True
+
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)])
+
+    assert not results['PACS'].ok and results['PACS'].message.startswith('Could not connect to network')
+    assert results['PACS'].files == 0 and pacs_host['files'] == {}
+
+
+def test_read_error_stops_every_destination(tmp_path):
+    session, files = make_session(tmp_path)
+    threads_before = threading.active_count()
+
+    def read(f):
+        if f == 'CT001.dcm':
+            raise IOError("disk error")
+        return None
+
+    sinks = [FakeSink('PACS', workers=3), FakeSink('WB')]
+    done = {}
+    t = threading.Thread(target=lambda: done.update(run(session, files, sinks, read=read)))
+    t.start()
+    t.join(10)
+    assert not t.is_alive()
+
+    for s in sinks:
+        r = done[s.name]
+        assert not r.ok and r.message.startswith('Could not read CT001.dcm')
+        #Files read before the error were sent, but the session isn't closed (or pushed to PACS)
+        assert sorted(s.sent) == ['CT000.dcm']
+        assert s.events == ['open', 'abort']
+    assert threading.active_count() == threads_before
+
+    #Resuming picks up from the unreadable file
+    sinks = [FakeSink('PACS', workers=3), FakeSink('WB')]
+    results = run(session, files, sinks)
+    assert all(r.ok for r in results.values())
+    assert all(sorted(s.sent) == files[1:] for s in sinks)
+
+
+def test_read_error_does_not_push_the_session_to_pacs(tmp_path, pacs_host):
+    session, files = make_session(tmp_path)
+
+    def read(f):
+        if f == 'CT002.dcm':
+            raise IOError("disk error")
+        return None
+
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)], read=read)
+
+    assert not results['PACS'].ok and results['PACS'].message.startswith('Could not read CT002.dcm')
+    assert not any(c.startswith('./upload_session_data_to_pacs.sh') for c in pacs_host['commands'])
+    assert all(client.closed for client in pacs_host['clients'])
+
+
+def test_cancel_aborts_instead_of_closing(tmp_path):
+    session, files = make_session(tmp_path)
+    cancel = threading.Event()
+    cancel.set()
+
+    sinks = [FakeSink('PACS', workers=2), FakeSink('WB')]
+    results = run(session, files, sinks, cancel=cancel)
+
+    assert all(r.message == 'Cancelled' and not r.ok for r in results.values())
+    assert all('close' not in s.events for s in sinks)
+
+
+def test_resume_only_sends_what_each_destination_is_missing(tmp_path):
+    session, files = make_session(tmp_path)
+
+    #WB fails on one file and sends nothing after it: PACS gets everything, WB the file before
+    pacs, wb = FakeSink('PACS', workers=2), FakeSink('WB', fail_on=['CT001.dcm'])
+    results = run(session, files, [pacs, wb])
+    assert results['PACS'].ok and results['PACS'].files == 4
+    assert not results['WB'].ok and 'CT001.dcm' in results['WB'].message
+    assert sorted(wb.sent) == ['CT000.dcm'] and wb.events == ['open', 'abort']
+
+    #The next run only sends WB the files it is missing
+    pacs, wb = FakeSink('PACS', workers=2), FakeSink('WB')
+    results = run(session, files, [pacs, wb])
+    assert pacs.sent == {} and pacs.events == [] and results['PACS'].message == 'Up to date'
+    assert sorted(wb.sent) == files[1:] and wb.events == ['open', 'close']
+    assert results['WB'].ok
+
+    #A changed file goes to both, nothing else does
+    with open(os.path.join(session, 'RTIP.dcm'), 'wb') as f:
+        f.write(b'new plan')
+    pacs, wb = FakeSink('PACS', workers=2), FakeSink('WB')
+    results = run(session, files, [pacs, wb])
+    assert pacs.sent == {'RTIP.dcm': b'new plan'} and wb.sent == {'RTIP.dcm': b'new plan'}
+    assert all(r.ok for r in results.values())
+
+    assert Dicom_upload.pending_sends(session, files) == 0
+
+
+def test_pacs_push_failure_is_retried_on_the_next_upload(tmp_path, pacs_host):
+    session, files = make_session(tmp_path)
+    push = './upload_session_data_to_pacs.sh ~/sessions/' + session
+
+    pacs_host['status'] = 1
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)])
+    assert not results['PACS'].ok and 'exited with 1' in results['PACS'].message
+    assert len(pacs_host['files']) == 4 and pacs_host['commands'][-1] == push
+    assert TransferManifest(session).needs_finalize('PACS')
+
+    #Every file is already on the host: nothing is sent again but the push script runs again
+    pacs_host['files'].clear()
+    pacs_host['status'] = 0
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)])
+    assert results['PACS'].ok and results['PACS'].files == 0
+    assert pacs_host['files'] == {} and pacs_host['commands'][-1] == push
+    assert pacs_host['commands'].count(push) == 2
+    assert not TransferManifest(session).needs_finalize('PACS')
+
+    #And once it went through the session is up to date, without connecting
+    results = run(session, files, [PacsSink(PACS_INFO, session, workers=2)])
+    assert results['PACS'].message == 'Up to date' and len(pacs_host['clients']) == 2
+
+
+def test_manifest_saves_deliveries_in_batches(tmp_path, monkeypatch):
+    session, files = make_session(tmp_path, ['CT%03d.dcm' % n for n in range(10)])
+    monkeypatch.setattr(Dicom_upload, 'MANIFEST_SAVE_FILES', 4)
+    monkeypatch.setattr(Dicom_upload, 'MANIFEST_SAVE_SECONDS', 3600)
+    saves = []
+    save = TransferManifest._save
+    monkeypatch.setattr(TransferManifest, '_save', lambda self: saves.append(1) or save(self))
+
+    results = run(session, files, [FakeSink('PACS', workers=2), FakeSink('WB')])
+
+    #20 deliveries in batches of 4, one save per finalized destination and the final save. A
+    #finalize save can also take deliveries still waiting for their batch, so at most that many
+    assert all(r.ok for r in results.values())
+    assert 2 + 1 < len(saves) <= 5 + 2 + 1
+    assert Dicom_upload.pending_sends(session, files) == 0
+    assert not any(TransferManifest(session).needs_finalize(d) for d in ('PACS', 'WB'))